@@ -1,5 +1,5 @@
 import streamlit as st
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APIStatusError, APITimeoutError
 from PIL import Image
 import requests
 from io import BytesIO
@@ -14,10 +14,31 @@ import os
 import re
 from urllib.parse import urlencode, quote
 import gc
+from email.utils import parsedate_to_datetime
+import hashlib
+import tempfile
+import math
+import itertools
+from collections import OrderedDict, deque
 from streamlit.errors import StreamlitAPIException, StreamlitSecretNotFoundError
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import threading
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import logging
+import sys
+import socket
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ReadTimeoutError
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 # 應用配置
 APP_TITLE = "🎨 AI 圖像生成器 (完整多模型版)"
@@ -28,7 +49,162 @@ VERSION = "v2.0.0"
 MAX_HISTORY_ITEMS = 25
 MAX_FAVORITE_ITEMS = 50
 MAX_BATCH_SIZE = 6
-REQUEST_TIMEOUT = 180
+REQUEST_TIMEOUT = 180  # 單次請求讀取超時上限（存檔可用 timeout_ceiling 覆蓋）
+
+# 併發批次生成配置
+GENERATION_POOL_SIZE = 16  # 進程級共享工作執行緒上限（全局併發上限，secrets [scheduler] 可覆蓋）
+SCHEDULER_SESSION_SHARE = 0.5  # 單個會話最多佔用全局併發的比例
+SCHEDULER_WAIT_WINDOW = 200  # 統計排隊等待時間的樣本數
+DEFAULT_PROVIDER_CONCURRENCY = {  # 自適應併發窗口的初始值
+    "Pollinations.ai": 4,
+    "NavyAI": 4,
+    "Hugging Face": 2,
+    "OpenAI Compatible": 4,
+}
+
+# AIMD 自適應併發：成功時窗口加性增長，429/503/超時時乘性減小
+AIMD_MIN_WINDOW = 1
+AIMD_INCREASE = 1.0  # 每個完整窗口的成功請求使窗口增加的數量
+AIMD_DECREASE = 0.5  # 過載時窗口的縮減比例
+AIMD_OVERLOAD_STATUSES = (429, 503, 504)
+
+# 對沖請求：超過模型 p90 延遲仍未返回時，發出一個相同種子的備份請求
+HEDGE_PERCENTILE = 0.9
+HEDGE_MIN_DELAY = 1.0  # 最短對沖等待（秒）
+HEDGE_BUDGET_RATIO = 0.1  # 對沖請求最多佔正常請求的比例
+HEDGE_BUDGET_BURST = 3  # 預算的累積上限
+HEDGE_POLL_INTERVAL = 0.1  # 主請求尚未發出時檢查其狀態的間隔（秒）
+
+# HTTP 連接池配置（可在存檔中以 http_pool_size / http_keepalive / http2 覆蓋）
+HTTP_POOL_SIZE = 16
+HTTP_KEEPALIVE_SECONDS = 60
+
+# 重試策略：按供應商配置，status_overrides 可針對特定狀態碼覆蓋
+RETRY_POLICIES = {
+    "default": {
+        "max_attempts": 3,
+        "base_delay": 1.0,
+        "max_delay": 20.0,
+        "retry_statuses": [408, 429, 500, 502, 503, 504],
+        "status_overrides": {},
+    },
+    "Pollinations.ai": {
+        "max_attempts": 4,
+        "base_delay": 2.0,
+        "status_overrides": {429: {"base_delay": 5.0, "max_delay": 60.0}},
+    },
+    "Hugging Face": {
+        "max_attempts": 4,
+        "base_delay": 2.0,
+        "status_overrides": {503: {"max_attempts": 6, "base_delay": 5.0, "max_delay": 60.0}},
+    },
+}
+BATCH_DEADLINE_SECONDS = 600  # 整個批次（含重試）的總時限
+
+# 自適應超時配置：按 (供應商, 模型) 的滾動延遲百分位數推導
+CONNECT_TIMEOUT = 10
+LATENCY_WINDOW = 50  # 每個模型保留的樣本數
+LATENCY_MIN_SAMPLES = 5  # 樣本不足時使用上限值
+TIMEOUT_MULTIPLIER = 2.0  # 超時 = 百分位數 × 倍數
+MIN_READ_TIMEOUT = 15
+STALL_TIMEOUT_MIN = 5  # 響應體下載停滯檢測範圍
+STALL_TIMEOUT_MAX = 30
+MIN_BATCH_BUDGET = 60
+
+# 熔斷器配置（按存檔 + 模型）
+CIRCUIT_FAILURE_THRESHOLD = 5  # 連續失敗多少次後斷開
+CIRCUIT_RESET_TIMEOUT = 60  # 斷開多少秒後允許一次半開探測
+
+# 客戶端令牌桶限流（按存檔 + 認證模式，secrets [rate_limits] 可覆蓋）
+# rate 為每秒補充的令牌數，burst 為桶容量；未列出的供應商不限流
+DEFAULT_RATE_LIMITS = {
+    "Pollinations.ai": {
+        "免費": {"rate": 1 / 15, "burst": 1},
+        "域名": {"rate": 1 / 5, "burst": 2},
+        "令牌": {"rate": 1 / 3, "burst": 3},
+    },
+    "Hugging Face": {
+        "*": {"rate": 1.0, "burst": 5},
+    },
+}
+
+# 模型冷啟動：Hugging Face 加載模型時返回 503 及 estimated_time
+HF_MAX_LOAD_WAIT = 300  # 單次等待模型加載的上限（秒）
+HF_LOAD_GRACE = 30  # 預計加載時間已過但仍未就緒時，額外保持連接等待的秒數
+HF_WARM_SECONDS = 600  # 最近一次成功後多久內視為已預熱
+HF_WARMUP_PARAMETERS = {"num_inference_steps": 1, "width": 256, "height": 256}
+KEEP_WARM_MINUTES = 15  # 保溫最近多少分鐘內用於生成的模型（secrets [huggingface] 可覆蓋，0 為關閉）
+KEEP_WARM_INTERVAL = 240  # 同一模型兩次保溫請求的最短間隔（秒）
+KEEP_WARM_CHECK_INTERVAL = 30
+WARMUP_FAILURE_BACKOFF = 300  # 預熱失敗（非加載中）後多久內不再預熱同一模型（秒）
+WARMUP_MAX_QUEUE = 5  # 預熱請求等待限流令牌的上限（秒），超過則放棄本次預熱
+
+# OpenAI 兼容接口單次請求的張數上限（存檔可用 max_images_per_call 覆蓋，其餘模型從錯誤響應中學習）
+OPENAI_MAX_IMAGES_PER_CALL = {
+    "dall-e-3": 1,
+    "dall-e-2": 10,
+    "gpt-image-1": 10,
+}
+OPENAI_DEFAULT_MAX_IMAGES = 10
+
+# 模型發現快取：按 (供應商, 端點, 憑證) 跨會話共享
+DISCOVERY_TTL_SECONDS = 3600  # 超過此時間在後台重新驗證，期間繼續使用舊結果
+DISCOVERY_MAX_STALE_SECONDS = 7 * 24 * 3600  # 超過此時間的舊結果不再使用
+DISCOVERY_RETRY_SECONDS = 300  # 發現失敗後再次嘗試的間隔
+DISCOVERY_TIMEOUT = 15
+
+# 存檔健康檢查：啟動時及定期在後台並發驗證存檔並刷新模型發現
+HEALTH_CHECK_INTERVAL = 300  # 同一存檔兩次檢查的最短間隔（秒）
+HEALTH_CHECK_TIMEOUT = 5  # 檢查時驗證和模型發現請求的讀取超時（秒）
+HEALTH_CHECK_WORKERS = 4
+HEALTH_LOOP_INTERVAL = 30
+HEALTH_IDLE_SECONDS = 3600  # 會話中的存檔超過此時間無人查看後停止定期檢查
+
+# 智能路由：按成功率、延遲、剩餘配額和成本為等效存檔評分（存檔可用 cost_per_image 覆蓋成本）
+DEFAULT_COST_PER_IMAGE = {  # 美元/張
+    "Pollinations.ai": 0.0,
+    "NavyAI": 0.01,
+    "Hugging Face": 0.0,
+    "OpenAI Compatible": 0.04,
+}
+ROUTING_WEIGHTS = {"success": 1.0, "latency": 0.5, "quota": 0.5, "cost": 0.3}
+ROUTING_LATENCY_REF = 30.0  # 延遲達到此秒數時延遲懲罰為一半
+ROUTING_QUOTA_REF = 15.0  # 限流等待達到此秒數時配額懲罰為一半
+ROUTING_COST_REF = 0.02  # 成本達到此金額時成本懲罰為一半
+ROUTING_SUCCESS_PRIOR = 0.9  # 未有記錄的存檔的初始成功率
+ROUTING_SUCCESS_ALPHA = 0.2  # 成功率的指數移動平均係數
+
+# 圖片下載與文件存儲配置
+BLOB_DIR = os.environ.get("IMAGE_BLOB_DIR", os.path.join("data", "blobs"))
+BLOB_MAX_BYTES = 1024 * 1024 * 1024
+BLOB_PIN_SECONDS = 7 * 24 * 3600  # 收藏的圖片不被淘汰的期限，收藏所在會話每次運行時續期
+MAX_IMAGE_BYTES = 32 * 1024 * 1024  # 單張圖片響應體上限
+IMAGE_CHUNK_SIZE = 64 * 1024
+
+# 生成結果磁碟快取配置
+CACHE_DIR = os.environ.get("GENERATION_CACHE_DIR", os.path.join("data", "cache"))
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# 後台生成任務配置
+JOB_WORKER_COUNT = 8  # 同時執行的生成任務上限（每個任務內部再併發請求圖片）
+MAX_ACTIVE_JOBS_PER_SESSION = 3
+JOB_POLL_INTERVAL = 1.0  # 界面輪詢任務狀態的間隔（秒）
+JOB_RETENTION_SECONDS = 1800  # 已結束但未被領取的任務保留時間
+
+# 取消：等待中的請求按此間隔檢查取消標記；瀏覽器斷開超過寬限期後自動取消該會話的任務
+CANCEL_POLL_INTERVAL = 0.5
+DISCONNECT_CHECK_INTERVAL = 2.0
+DISCONNECT_GRACE_SECONDS = 15
+
+# 參數掃描配置
+SWEEP_MAX_CELLS = 60  # 展開去重後的請求數上限
+SWEEP_CONCURRENCY = 4  # 單次掃描同時進行的請求數
+SWEEP_GRID_COLUMNS = 4
+
+# 結果網格：每張圖片有固定位置，完成前顯示與目標比例相同的佔位圖
+RESULT_GRID_COLUMNS = 2
+PLACEHOLDER_WIDTH = 64
 
 # 擴展的圖像尺寸預設
 IMAGE_SIZES = {
@@ -249,6 +425,37 @@ API_PROVIDERS = {
     }
 }
 
+# 跨供應商的等效模型（競速模式用）：模型族 -> {供應商: 模型 ID}
+MODEL_EQUIVALENCE = {
+    "flux-schnell": {
+        "Pollinations.ai": "flux-schnell",
+        "NavyAI": "flux-schnell",
+        "OpenAI Compatible": "black-forest-labs/FLUX.1-schnell",
+    },
+    "flux-dev": {
+        "Pollinations.ai": "flux-dev",
+        "Hugging Face": "flux-1-dev",
+        "OpenAI Compatible": "black-forest-labs/FLUX.1-dev",
+    },
+    "flux-pro": {
+        "Pollinations.ai": "flux-1.1-pro",
+        "NavyAI": "flux-pro",
+        "OpenAI Compatible": "black-forest-labs/FLUX.1.1-pro",
+    },
+    "sdxl": {
+        "Pollinations.ai": "stable-diffusion-xl",
+        "NavyAI": "stable-diffusion-xl",
+        "Hugging Face": "stable-diffusion-xl-base-1.0",
+        "OpenAI Compatible": "stabilityai/stable-diffusion-xl-base-1.0",
+    },
+    "dalle-3": {
+        "Pollinations.ai": "dalle-3",
+        "NavyAI": "dalle-3",
+        "OpenAI Compatible": "dall-e-3",
+    },
+}
+RACE_MAX_CANDIDATES = 3  # 競速時最多同時請求的存檔數（含當前存檔）
+
 # 基礎模型集合（後備選項）
 BASE_MODELS = {
     "flux.1-schnell": {"name": "FLUX.1 Schnell", "icon": "⚡", "priority": 1, "category": "FLUX", "description": "快速FLUX生成"},
@@ -258,29 +465,33 @@ BASE_MODELS = {
 
 # === 核心功能函數 ===
 
+def load_base_profiles() -> Dict[str, Dict]:
+    """從 secrets 載入 API 存檔，未配置時返回默認的 Pollinations 存檔"""
+    try:
+        base_profiles = st.secrets.get("api_profiles", {})
+    except StreamlitSecretNotFoundError:
+        base_profiles = {}
+    
+    # 默認配置
+    default_profiles = {
+        "預設 Pollinations": {
+            'provider': 'Pollinations.ai',
+            'api_key': '',
+            'base_url': 'https://image.pollinations.ai',
+            'validated': True,
+            'pollinations_auth_mode': '免費',
+            'pollinations_token': '',
+            'pollinations_referrer': ''
+        }
+    }
+    
+    return {name: dict(cfg) for name, cfg in base_profiles.items()} if base_profiles else default_profiles
+
 def init_session_state():
     """初始化會話狀態"""
     # API配置初始化
     if 'api_profiles' not in st.session_state:
-        try:
-            base_profiles = st.secrets.get("api_profiles", {})
-        except StreamlitSecretNotFoundError:
-            base_profiles = {}
-        
-        # 默認配置
-        default_profiles = {
-            "預設 Pollinations": {
-                'provider': 'Pollinations.ai',
-                'api_key': '',
-                'base_url': 'https://image.pollinations.ai',
-                'validated': True,
-                'pollinations_auth_mode': '免費',
-                'pollinations_token': '',
-                'pollinations_referrer': ''
-            }
-        }
-        
-        st.session_state.api_profiles = base_profiles.copy() if base_profiles else default_profiles
+        st.session_state.api_profiles = load_base_profiles()
     
     # 活動配置初始化
     if ('active_profile_name' not in st.session_state or 
@@ -294,9 +505,11 @@ def init_session_state():
     defaults = {
         'generation_history': [],
         'favorite_images': [],
-        'discovered_models': {},
         'selected_model': None,
-        'generation_in_progress': False,
+        'active_jobs': [],
+        'last_job_result': None,
+        'active_sweep': None,
+        'last_sweep': None,
         'last_generation_time': None,
         'ui_theme': 'light',
         'advanced_mode': False,
@@ -307,12 +520,18 @@ def init_session_state():
         if key not in st.session_state:
             st.session_state[key] = value
 
+def build_final_prompt(prompt: str, style: str) -> str:
+    """附加風格預設的提示詞"""
+    if style and style != "無" and STYLE_PRESETS.get(style):
+        return f"{prompt}, {STYLE_PRESETS[style]}"
+    return prompt
+
 def get_active_config() -> Dict:
     """獲取當前活動的API配置"""
     return st.session_state.api_profiles.get(st.session_state.active_profile_name, {})
 
-def validate_api_key(api_key: str, base_url: str, provider: str) -> Tuple[bool, str]:
-    """驗證API密鑰"""
+def validate_api_key(api_key: str, base_url: str, provider: str, timeout: float = 10) -> Tuple[Optional[bool], str]:
+    """驗證API密鑰：被拒絕（401/403）時返回 False，超時、連接失敗或 5xx 等無法判斷時返回 None"""
     try:
         if provider == "Pollinations.ai":
             return True, "Pollinations.ai 無需驗證"
@@ -322,84 +541,91 @@ def validate_api_key(api_key: str, base_url: str, provider: str) -> Tuple[bool,
                 return False, "Hugging Face 需要 API Token"
             
             headers = {"Authorization": f"Bearer {api_key}"}
-            response = requests.get(f"{base_url}/models", headers=headers, timeout=10)
+            response = get_http_transport(base_url).get(f"{base_url}/models", headers=headers,
+                                                        timeout=(CONNECT_TIMEOUT, timeout))
             
             if response.status_code == 200:
                 return True, "Hugging Face API Token 驗證成功"
-            else:
+            elif response.status_code in (401, 403):
                 return False, f"Hugging Face API 驗證失敗: {response.status_code}"
+            else:
+                return None, f"Hugging Face API 暫時無法驗證: {response.status_code}"
         
         else:
             # OpenAI兼容API驗證
-            client = OpenAI(api_key=api_key, base_url=base_url)
-            client.models.list()
+            client = get_openai_client(api_key, base_url)
+            client.with_options(timeout=timeout).models.list()
             return True, "API 密鑰驗證成功"
             
     except Exception as e:
-        return False, f"API 驗證失敗: {str(e)[:100]}"
+        _, status_code, _ = classify_error(e)
+        if status_code in (401, 403):
+            return False, f"API 驗證失敗: {str(e)[:100]}"
+        return None, f"API 暫時無法驗證: {str(e)[:100]}"
 
-def auto_discover_models(client, provider: str, base_url: str) -> Dict[str, Dict]:
-    """自動發現可用模型"""
-    discovered = {}
+def fetch_model_ids(cfg: Dict, etag: Optional[str] = None,
+                    timeout: float = DISCOVERY_TIMEOUT) -> Tuple[Optional[List[str]], Optional[str]]:
+    """請求端點的模型列表並返回 (模型 ID 列表, ETag)；帶 If-None-Match 且內容未變化（304）時模型列表為 None"""
+    provider = cfg.get('provider')
+    
+    if provider == "Hugging Face":
+        # HF 沒有按任務列出模型的端點，使用熱門模型列表
+        popular_models = [
+            "runwayml/stable-diffusion-v1-5",
+            "stabilityai/stable-diffusion-xl-base-1.0",
+            "black-forest-labs/flux-schnell",
+            "stabilityai/stable-diffusion-2-1",
+        ]
+        return popular_models, None
     
+    base_url = cfg['base_url'].rstrip('/')
+    headers = {}
+    if provider != "Pollinations.ai":
+        # 與 client.models.list() 相同的端點，改用共享傳輸層以支持條件請求
+        headers["Authorization"] = f"Bearer {cfg.get('api_key', '')}"
+    if etag:
+        headers["If-None-Match"] = etag
+    
+    response = get_http_transport(base_url, cfg).get(
+        f"{base_url}/models", headers=headers, timeout=(CONNECT_TIMEOUT, timeout)
+    )
     try:
+        if response.status_code == 304:
+            return None, etag
+        raise_for_generation_status(response)
+        body = response.json()
+        new_etag = response.headers.get("ETag")
+    finally:
+        response.close()
+    
+    # Pollinations 返回名稱列表，OpenAI 兼容接口返回 {"data": [{"id": ...}]}
+    items = body.get("data", []) if isinstance(body, dict) else body
+    model_ids = [item.get("id") or item.get("name") if isinstance(item, dict) else str(item) for item in items]
+    return [model_id for model_id in model_ids if model_id], new_etag
+
+def build_discovered_models(provider: str, model_ids: List[str]) -> Dict[str, Dict]:
+    """把模型 ID 轉換為模型信息，OpenAI 兼容接口只保留圖像模型"""
+    discovered = {}
+    
+    for model_id in model_ids:
         if provider == "Pollinations.ai":
-            response = requests.get(f"{base_url}/models", timeout=15)
-            if response.ok:
-                models = response.json()
-                for model_name in models:
-                    # 智能分類
-                    category = categorize_model_name(model_name)
-                    icon = get_model_icon(model_name, category)
-                    
-                    discovered[model_name] = {
-                        "name": format_model_name(model_name),
-                        "icon": icon,
-                        "category": category,
-                        "description": f"Pollinations {category} 模型"
-                    }
-            else:
-                st.warning(f"無法從 Pollinations 獲取模型列表: HTTP {response.status_code}")
-        
+            name, description = format_model_name(model_id), "Pollinations"
         elif provider == "Hugging Face":
-            # HF模型發現邏輯
-            popular_models = [
-                "runwayml/stable-diffusion-v1-5",
-                "stabilityai/stable-diffusion-xl-base-1.0",
-                "black-forest-labs/flux-schnell",
-                "stabilityai/stable-diffusion-2-1",
-            ]
-            
-            for model_id in popular_models:
-                category = categorize_model_name(model_id)
-                icon = get_model_icon(model_id, category)
-                
-                discovered[model_id] = {
-                    "name": format_model_name(model_id.split('/')[-1]),
-                    "icon": icon,
-                    "category": category,
-                    "description": f"HF {category} 模型"
-                }
+            name, description = format_model_name(model_id.split('/')[-1]), "HF"
+        elif any(keyword in model_id.lower() for keyword in
+                 ['flux', 'stable', 'dall', 'midjourney', 'sd', 'xl']):
+            name, description = format_model_name(model_id), "API"
+        else:
+            continue
         
-        elif client:
-            # OpenAI兼容API模型發現
-            models = client.models.list().data
-            for model in models:
-                if any(keyword in model.id.lower() for keyword in 
-                      ['flux', 'stable', 'dall', 'midjourney', 'sd', 'xl']):
-                    
-                    category = categorize_model_name(model.id)
-                    icon = get_model_icon(model.id, category)
-                    
-                    discovered[model.id] = {
-                        "name": format_model_name(model.id),
-                        "icon": icon,
-                        "category": category,
-                        "description": f"API {category} 模型"
-                    }
-    
-    except Exception as e:
-        st.error(f"模型發現失敗: {str(e)[:100]}")
+        # 智能分類
+        category = categorize_model_name(model_id)
+        discovered[model_id] = {
+            "name": name,
+            "icon": get_model_icon(model_id, category),
+            "category": category,
+            "description": f"{description} {category} 模型"
+        }
     
     return discovered
 
@@ -452,8 +678,10 @@ def format_model_name(model_name: str) -> str:
 
 def merge_models() -> Dict[str, Dict]:
     """合併硬編碼和發現的模型"""
-    provider = get_active_config().get('provider')
-    discovered = st.session_state.get('discovered_models', {})
+    cfg = get_active_config()
+    provider = cfg.get('provider')
+    # 只讀取共享快取，過期或未發現時在後台刷新，不阻塞頁面
+    discovered = get_model_discovery().get(cfg) if cfg.get('validated') else {}
     
     if provider in API_PROVIDERS:
         hardcoded = API_PROVIDERS[provider].get('hardcoded_models', {})
@@ -487,187 +715,2829 @@ def get_models_by_category(models: Dict[str, Dict]) -> Dict[str, Dict[str, Dict]
     
     return sorted_categorized
 
-# === 圖像生成功能 ===
+# === HTTP 傳輸層 ===
 
-def generate_images_with_retry(client, **params) -> Tuple[bool, any]:
-    """統一的圖像生成入口"""
-    provider = get_active_config().get('provider')
-    n_images = params.get("n", 1)
+class HttpxResponse:
+    """將 httpx 響應包裝為 requests 風格的接口"""
+    
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.ok = response.is_success
+    
+    @property
+    def content(self) -> bytes:
+        return self._response.read()
+    
+    def json(self):
+        return json.loads(self.content)
+    
+    def iter_content(self, chunk_size: int = 65536):
+        # 讀取響應體期間的 httpx 異常同樣轉換為 requests 異常
+        try:
+            yield from self._response.iter_bytes(chunk_size)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+    
+    def close(self):
+        self._response.close()
+
+class StreamingResponse:
+    """流式響應包裝：響應關閉時才結束傳輸層的進行中登記，避免連接池在讀取響應體期間被回收"""
+    
+    def __init__(self, response, release):
+        self._response = response
+        self._release = release
+        self._released = False
+    
+    def __getattr__(self, name: str):
+        return getattr(self._response, name)
+    
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+@st.cache_resource
+def get_active_request() -> threading.local:
+    """獲取當前執行緒正在發出的圖片請求上下文（ctx），連接池取出連接時登記到其上，以便取消時關閉套接字"""
+    # 腳本每次重跑都會重新定義模組級變量，而共享的連接池仍由較早的運行創建，因此放在進程級快取中
+    return threading.local()
+
+class CancellableConnectionMixin:
+    """取出連接時登記到當前請求上下文"""
+    
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        ctx = getattr(get_active_request(), "ctx", None)
+        if ctx is not None:
+            ctx.connection = conn
+        return conn
+
+class CancellableHTTPConnectionPool(CancellableConnectionMixin, HTTPConnectionPool):
+    pass
+
+class CancellableHTTPSConnectionPool(CancellableConnectionMixin, HTTPSConnectionPool):
+    pass
+
+class HttpTransport:
+    """按端點共享的長連接傳輸層，線程安全，可跨會話復用"""
+    
+    def __init__(self, pool_size: int, keepalive: float, http2: bool = False):
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.http2 = http2 and httpx is not None
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._last_used = time.monotonic()
+        self._client = self._create_client()
+    
+    def _create_client(self):
+        """創建底層連接池客戶端"""
+        if self.http2:
+            try:
+                return httpx.Client(
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=self.pool_size,
+                        max_keepalive_connections=self.pool_size,
+                        keepalive_expiry=self.keepalive
+                    )
+                )
+            except ImportError:
+                # 未安裝 h2 時退回 HTTP/1.1
+                self.http2 = False
+        
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        adapter.poolmanager.pool_classes_by_scheme = {
+            "http": CancellableHTTPConnectionPool, "https": CancellableHTTPSConnectionPool
+        }
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+    
+    def _acquire(self):
+        """登記請求，並回收空閒超過 keep-alive 的連接池"""
+        with self._lock:
+            idle = time.monotonic() - self._last_used
+            if self._in_flight == 0 and idle > self.keepalive:
+                self._client.close()
+                self._client = self._create_client()
+            self._in_flight += 1
+            return self._client
+    
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._last_used = time.monotonic()
+    
+    def request(self, method: str, url: str, **kwargs):
+        """發送請求，返回 requests 風格的響應"""
+        client = self._acquire()
+        try:
+            if not self.http2:
+                response = client.request(method, url, **kwargs)
+            else:
+                response = self._httpx_request(client, method, url, **kwargs)
+        except BaseException:
+            self._release()
+            raise
+        
+        if not kwargs.get("stream"):
+            self._release()
+            return response
+        # 流式響應在調用方關閉後才歸還
+        return StreamingResponse(response, self._release)
+    
+    def _httpx_request(self, client, method: str, url: str, timeout=None, stream: bool = False, **kwargs):
+        """通過 httpx 發送請求，並將異常轉換為 requests 異常"""
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        
+        try:
+            request = client.build_request(method, url, timeout=timeout, **kwargs)
+            response = client.send(request, stream=stream)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        
+        return HttpxResponse(response)
+    
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+    
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+@st.cache_resource
+def get_transport_registry() -> Dict:
+    """獲取進程級傳輸層註冊表"""
+    return {"lock": threading.Lock(), "transports": {}}
+
+def get_http_transport(base_url: str, cfg: Optional[Dict] = None) -> HttpTransport:
+    """獲取指定端點共享的連接池傳輸層"""
+    cfg = cfg or {}
+    pool_size = int(cfg.get('http_pool_size') or HTTP_POOL_SIZE)
+    keepalive = float(cfg.get('http_keepalive') or HTTP_KEEPALIVE_SECONDS)
+    http2 = bool(cfg.get('http2', False))
+    
+    key = (base_url.rstrip('/'), pool_size, keepalive, http2)
+    registry = get_transport_registry()
+    
+    with registry["lock"]:
+        if key not in registry["transports"]:
+            registry["transports"][key] = HttpTransport(pool_size, keepalive, http2)
+        return registry["transports"][key]
+
+@st.cache_resource
+def get_openai_client(api_key: str, base_url: str) -> OpenAI:
+    """獲取共享的 OpenAI 客戶端（復用其內部連接池）"""
+    # 由 call_with_retry 統一處理重試
+    return OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+
+# === 併發執行 ===
+
+class GenerationError(Exception):
+    """單張圖片生成失敗"""
+    
+    def __init__(self, message: str, status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+class ModelLoadingError(GenerationError):
+    """模型冷啟動加載中（不視為上游故障或過載），retry_after 為預計加載秒數"""
+    
+    def __init__(self, estimated_time: float):
+        super().__init__(f"模型加載中，預計 {estimated_time:.0f} 秒",
+                         status_code=503, retry_after=min(estimated_time, HF_MAX_LOAD_WAIT))
+        self.estimated_time = estimated_time
+
+def parse_loading_estimate(response) -> Optional[float]:
+    """解析模型加載中響應的預計秒數（{"error": ..., "estimated_time": 秒}），其他響應返回 None"""
+    try:
+        body = response.json()
+        return max(0.0, float(body["estimated_time"]))
+    except (ValueError, TypeError, KeyError):
+        return None
+
+class RequestCancelled(GenerationError):
+    """請求所屬的任務已被取消（用戶取消或瀏覽器已斷開）"""
+    
+    def __init__(self):
+        super().__init__("請求已取消")
+
+def sleep_unless_cancelled(seconds: float, cancelled=None):
+    """分段睡眠，期間被取消時立即拋出 RequestCancelled"""
+    end = time.monotonic() + seconds
+    while True:
+        if cancelled is not None and cancelled():
+            raise RequestCancelled()
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, CANCEL_POLL_INTERVAL) if cancelled is not None else remaining)
+
+def raise_for_generation_status(response):
+    """非成功響應轉換為 GenerationError，並附帶 Retry-After 信息"""
+    if not response.ok:
+        if response.status_code == 503 and (estimated := parse_loading_estimate(response)) is not None:
+            raise ModelLoadingError(estimated)
+        raise GenerationError(
+            f"HTTP {response.status_code}",
+            status_code=response.status_code,
+            retry_after=parse_retry_after(response.headers.get("Retry-After"))
+        )
+
+class FairScheduler:
+    """跨會話公平排程：按會話分隊列，以差額輪詢 (DRR) 分配全局併發名額，名額只在發出上游請求期間佔用"""
+    
+    def __init__(self, capacity: int, session_share: float, quantum: int = 1):
+        self.capacity = capacity
+        self.per_session = max(1, int(capacity * session_share))
+        self.quantum = quantum
+        self._cond = threading.Condition()
+        self._queues: Dict[str, deque] = {}
+        self._deficit: Dict[str, int] = {}
+        self._inflight: Dict[str, int] = {}
+        self._order = deque()
+        self._reserved: Optional[str] = None
+        self._running = 0
+        self._waits = deque(maxlen=SCHEDULER_WAIT_WINDOW)
+    
+    def acquire(self, session: str, cost: int = 1, deadline: Optional[float] = None, cancelled=None) -> int:
+        """在會話隊列中等待名額，一次請求 cost 張圖片佔用 cost 個名額（不超過會話份額），返回佔用的名額數"""
+        session = session or "anonymous"
+        waiter = {"cost": min(max(1, cost), self.per_session), "granted": False, "queued_at": time.monotonic()}
+        with self._cond:
+            if session not in self._queues:
+                self._queues[session] = deque()
+                self._deficit[session] = 0
+                self._order.append(session)
+            self._queues[session].append(waiter)
+            self._dispatch()
+            
+            while not waiter["granted"]:
+                if cancelled is not None and cancelled():
+                    self._abandon(session, waiter)
+                    raise RequestCancelled()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._abandon(session, waiter)
+                    raise GenerationError("等待排程名額超過批次時限")
+                if cancelled is not None:
+                    remaining = CANCEL_POLL_INTERVAL if remaining is None else min(remaining, CANCEL_POLL_INTERVAL)
+                self._cond.wait(timeout=remaining)
+            return waiter["cost"]
+    
+    def release(self, session: str, slots: int):
+        """歸還名額並分配給排隊中的請求"""
+        session = session or "anonymous"
+        with self._cond:
+            self._running -= slots
+            self._inflight[session] -= slots
+            if not self._inflight[session]:
+                del self._inflight[session]
+            self._dispatch()
+    
+    def run(self, session: str, fn, cost: int = 1, deadline: Optional[float] = None, cancelled=None):
+        """在排程名額內執行 fn；限流、併發窗口和重試退避的等待應在此之外完成"""
+        slots = self.acquire(session, cost, deadline, cancelled)
+        try:
+            return fn()
+        finally:
+            self.release(session, slots)
+    
+    def _dispatch(self):
+        """在持有鎖時調用：按輪詢順序給各會話補充額度，額度足夠、名額足夠且未超出份額即放行"""
+        while self._order:
+            if self._reserved is not None:
+                # 已輪到但名額不足的請求優先取得之後空出的名額，避免被小請求持續插隊
+                if self._running + self._queues[self._reserved][0]["cost"] > self.capacity:
+                    break
+                session, self._reserved = self._reserved, None
+                self._grant(session)
+                continue
+            
+            if self._running >= self.capacity:
+                break
+            
+            eligible = False
+            for _ in range(len(self._order)):
+                session = self._order[0]
+                self._order.rotate(-1)
+                waiter = self._queues[session][0]
+                if self._inflight.get(session, 0) + waiter["cost"] > self.per_session:
+                    continue
+                
+                eligible = True
+                self._deficit[session] += self.quantum
+                if waiter["cost"] > self._deficit[session]:
+                    continue
+                
+                if self._running + waiter["cost"] > self.capacity:
+                    self._reserved = session
+                else:
+                    self._grant(session)
+                break
+            else:
+                if not eligible:
+                    break
+        self._cond.notify_all()
+    
+    def _grant(self, session: str):
+        waiter = self._queues[session].popleft()
+        self._deficit[session] -= waiter["cost"]
+        if not self._queues[session]:
+            # 隊列清空的會話不保留額度，避免之後突發佔用
+            self._remove_session(session)
+        
+        waiter["granted"] = True
+        self._running += waiter["cost"]
+        self._inflight[session] = self._inflight.get(session, 0) + waiter["cost"]
+        self._waits.append(time.monotonic() - waiter["queued_at"])
+    
+    def _abandon(self, session: str, waiter: Dict):
+        """移除超時或取消的排隊請求"""
+        queue = self._queues[session]
+        if queue[0] is waiter and self._reserved == session:
+            self._reserved = None
+        queue.remove(waiter)
+        if not queue:
+            self._remove_session(session)
+        self._dispatch()
+    
+    def _remove_session(self, session: str):
+        del self._queues[session], self._deficit[session]
+        self._order.remove(session)
+    
+    def snapshot(self) -> Dict:
+        """返回排程器狀態及排隊等待時間的 p95"""
+        with self._cond:
+            waits = sorted(self._waits)
+            return {
+                "running": self._running,
+                "capacity": self.capacity,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "sessions": len(set(self._queues) | set(self._inflight)),
+                "wait_p95": waits[min(len(waits) - 1, int(0.95 * len(waits)))] if waits else None,
+            }
+
+@st.cache_resource
+def get_fair_scheduler() -> FairScheduler:
+    """獲取進程級共享的公平排程器（所有生成請求都經由此處發出）"""
+    try:
+        settings = st.secrets.get("scheduler", {})
+    except StreamlitSecretNotFoundError:
+        settings = {}
+    
+    capacity = max(1, int(settings.get("max_concurrency", GENERATION_POOL_SIZE)))
+    share = min(1.0, max(0.0, float(settings.get("session_share", SCHEDULER_SESSION_SHARE))))
+    return FairScheduler(capacity, share)
+
+class AIMDLimiter:
+    """按 AIMD（加性增、乘性減）自動調整的併發窗口，跨會話共享"""
+    
+    def __init__(self, initial: int, ceiling: int, floor: int = AIMD_MIN_WINDOW):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.window = float(min(max(initial, floor), self.ceiling))
+        self.in_flight = 0
+        self.stats = {"increases": 0, "decreases": 0}
+        self._epoch = 0
+        self._cond = threading.Condition()
+    
+    def acquire(self, deadline: Optional[float] = None, cancelled=None) -> int:
+        """等待窗口內的空閒名額，返回當前窗口週期編號"""
+        with self._cond:
+            while self.in_flight >= int(self.window):
+                if cancelled is not None and cancelled():
+                    raise RequestCancelled()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise GenerationError("等待併發名額超過批次時限")
+                if cancelled is not None:
+                    remaining = CANCEL_POLL_INTERVAL if remaining is None else min(remaining, CANCEL_POLL_INTERVAL)
+                self._cond.wait(timeout=remaining)
+            self.in_flight += 1
+            return self._epoch
+    
+    def release(self, epoch: int, outcome: str):
+        """歸還名額並按結果調整窗口：success 增長、overload 減小、其他不變"""
+        with self._cond:
+            # 只有窗口被用滿時的成功才說明上游還能承受更多請求
+            saturated = self.in_flight >= int(self.window)
+            self.in_flight -= 1
+            if outcome == "success" and saturated and self.window < self.ceiling:
+                self.window = min(self.ceiling, self.window + AIMD_INCREASE / self.window)
+                self.stats["increases"] += 1
+            elif outcome == "overload" and epoch == self._epoch:
+                # 同一窗口週期內發出的請求同時失敗時只縮減一次（類似 TCP 每個 RTT 只減半一次）
+                self.window = max(self.floor, self.window * AIMD_DECREASE)
+                self.stats["decreases"] += 1
+                self._epoch += 1
+            self._cond.notify_all()
+    
+    def run(self, fn, deadline: Optional[float] = None, cancelled=None):
+        """在窗口名額內執行 fn，並以其結果作為擁塞反饋"""
+        epoch = self.acquire(deadline, cancelled)
+        try:
+            result = fn()
+        except Exception as e:
+            self.release(epoch, "overload" if is_overload_signal(e) else "neutral")
+            raise
+        self.release(epoch, "success")
+        return result
+    
+    def snapshot(self) -> Dict:
+        with self._cond:
+            return {"window": self.window, "ceiling": self.ceiling, "in_flight": self.in_flight, **self.stats}
+
+def is_overload_signal(error: Exception) -> bool:
+    """判斷錯誤是否表示上游過載（限流、服務不可用或超時）"""
+    if isinstance(error, ModelLoadingError):
+        return False
+    if isinstance(error, (requests.exceptions.Timeout, APITimeoutError)):
+        return True
+    _, status_code, _ = classify_error(error)
+    return status_code in AIMD_OVERLOAD_STATUSES
+
+@st.cache_resource
+def get_concurrency_registry() -> Dict:
+    """獲取各存檔自適應併發窗口的註冊表"""
+    return {"lock": threading.Lock(), "limiters": {}}
+
+def get_provider_concurrency(cfg: Dict) -> int:
+    """獲取存檔配置的初始併發窗口"""
+    default = DEFAULT_PROVIDER_CONCURRENCY.get(cfg.get('provider'), 2)
+    try:
+        limit = int(cfg.get('max_concurrency') or default)
+    except (TypeError, ValueError):
+        limit = default
+    return max(1, min(limit, GENERATION_POOL_SIZE))
+
+def get_concurrency_limiter(cfg: Dict) -> AIMDLimiter:
+    """獲取存檔的自適應併發窗口（修改初始值後重新學習）"""
+    initial = get_provider_concurrency(cfg)
+    key = (endpoint_key(cfg), initial)
+    registry = get_concurrency_registry()
+    
+    with registry["lock"]:
+        if key not in registry["limiters"]:
+            registry["limiters"][key] = AIMDLimiter(initial, GENERATION_POOL_SIZE)
+        return registry["limiters"][key]
+
+class SingleFlight:
+    """合併進行中的相同請求，讓並發的調用者共享同一次上游調用結果"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = {"leaders": 0, "shared": 0}
+    
+    def do(self, key: str, fn):
+        """執行 fn，若相同 key 的調用正在進行中則等待並共享其結果"""
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+                self.stats["leaders"] += 1
+            else:
+                self.stats["shared"] += 1
+        
+        if not is_leader:
+            try:
+                return future.result()
+            except RequestCancelled:
+                # 發起者被取消不代表共享者也要放棄，改為自行發起
+                return self.do(key, fn)
+        
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    """獲取進程級共享的請求合併器"""
+    return SingleFlight()
+
+def credential_fingerprint(cfg: Dict) -> str:
+    """計算憑證指紋，避免不同帳號之間共享配額"""
+    secret = "|".join(str(cfg.get(k, '')) for k in
+                      ('api_key', 'pollinations_auth_mode', 'pollinations_token', 'pollinations_referrer'))
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()[:16]
+
+def build_flight_key(cfg: Dict, params: Dict, slot: Optional[int] = None) -> str:
+    """計算請求合併鍵：相同憑證下相同請求的同一張圖片（params 需含實際使用的種子，合併後記錄的種子才與圖片一致）"""
+    if slot is not None:
+        # 逐張請求與批次大小無關
+        params = {k: v for k, v in params.items() if k != "n"}
+    return f"{credential_fingerprint(cfg)}:{build_cache_key(cfg, params)}:{slot}"
+
+class RequestContext:
+    """單張圖片請求的執行上下文：批次時限、下載進度回報與取消標記"""
+    
+    def __init__(self, deadline: Optional[float] = None, on_progress=None, cancelled=None):
+        self.deadline = deadline
+        self.on_progress = on_progress
+        self.cancelled = cancelled or (lambda: False)
+        self.connection = None
+        self._lock = threading.Lock()
+    
+    def report_progress(self, downloaded: int, expected: int):
+        if self.on_progress is not None:
+            self.on_progress(downloaded, expected)
+    
+    def abort(self) -> bool:
+        """關閉請求正在使用的套接字，使阻塞中的讀取立即返回"""
+        with self._lock:
+            sock = getattr(self.connection, "sock", None)
+            if sock is None:
+                return False
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.connection = None
+            return True
+    
+    def detach(self):
+        """連接歸還連接池前解除登記，之後不會再被關閉"""
+        with self._lock:
+            self.connection = None
+
+class CancelWatcher:
+    """監視進行中的圖片請求，所屬任務被取消時關閉其連接，不必等到超時"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._contexts = set()
+        self.stats = {"aborted": 0}
+        threading.Thread(target=self._loop, name="cancel-watcher", daemon=True).start()
+    
+    def add(self, ctx: RequestContext):
+        with self._lock:
+            self._contexts.add(ctx)
+    
+    def discard(self, ctx: RequestContext):
+        with self._lock:
+            self._contexts.discard(ctx)
+    
+    def _loop(self):
+        while True:
+            time.sleep(CANCEL_POLL_INTERVAL)
+            with self._lock:
+                cancelled = [ctx for ctx in self._contexts if ctx.cancelled()]
+            for ctx in cancelled:
+                if ctx.abort():
+                    self.stats["aborted"] += 1
+
+@st.cache_resource
+def get_cancel_watcher() -> CancelWatcher:
+    """獲取進程級請求取消監視器"""
+    return CancelWatcher()
+
+class HedgeBudget:
+    """對沖請求預算：每個正常請求累積一定比例的額度，每次對沖消耗一個"""
+    
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        # 從零開始累積，進程剛啟動時不會免費對沖最初的請求
+        self._credit = 0.0
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "hedges": 0, "wins": 0, "denied": 0}
+    
+    def deposit(self):
+        with self._lock:
+            self.stats["requests"] += 1
+            # 取整避免浮點累加誤差（如 10 × 0.1 略小於 1）
+            self._credit = min(self.burst, round(self._credit + self.ratio, 6))
+    
+    def withdraw(self) -> bool:
+        """嘗試為一次對沖扣除額度，預算不足時返回 False"""
+        with self._lock:
+            if self._credit < 1:
+                self.stats["denied"] += 1
+                return False
+            self._credit -= 1
+            self.stats["hedges"] += 1
+            return True
+    
+    def record_win(self):
+        with self._lock:
+            self.stats["wins"] += 1
+    
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self.stats)
+
+@st.cache_resource
+def get_hedge_registry() -> Dict:
+    """獲取各存檔對沖預算的註冊表"""
+    return {"lock": threading.Lock(), "budgets": {}}
+
+def get_hedge_budget(cfg: Dict) -> HedgeBudget:
+    """獲取存檔共享的對沖預算"""
+    key = endpoint_key(cfg)
+    registry = get_hedge_registry()
+    
+    with registry["lock"]:
+        if key not in registry["budgets"]:
+            registry["budgets"][key] = HedgeBudget(HEDGE_BUDGET_RATIO, HEDGE_BUDGET_BURST)
+        return registry["budgets"][key]
+
+@st.cache_resource
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """獲取對沖請求專用的執行緒池（主請求與備份請求各佔一個執行緒）"""
+    return ThreadPoolExecutor(max_workers=GENERATION_POOL_SIZE * 2, thread_name_prefix="hedge")
+
+class BatchReporter:
+    """批次執行過程的事件接收者（默認忽略所有事件），可在工作執行緒中調用"""
+    
+    owner = ""  # 發起請求的會話 ID，用於公平排程
+    
+    def report_progress(self, completed: int, total: int, fraction: float, downloaded_bytes: int):
+        pass
+    
+    def report_image(self, index: int, blob_id: str):
+        pass
+    
+    def report_failure(self, index: int, message: str):
+        pass
+    
+    def cancelled(self) -> bool:
+        """返回 True 時批次不再發出新的請求"""
+        return False
+
+def run_concurrent_batch(cfg: Dict, n_images: int, request_fn, reporter: Optional[BatchReporter] = None,
+                         flight_key_fn=None, model: Optional[str] = None, hedge: bool = False) -> List[Tuple[int, str]]:
+    """通過有界執行緒池併發執行批次請求，按完成順序回報進度，返回成功的 (序號, 圖片文件 ID)"""
+    reporter = reporter or BatchReporter()
+    concurrency = get_concurrency_limiter(cfg)
+    limiter = get_rate_limiter(cfg)
+    scheduler = get_fair_scheduler()
+    flights = get_single_flight()
+    
+    provider = cfg.get('provider')
+    breaker = get_circuit_breaker(cfg, model)
+    tracker = get_latency_tracker(provider, model)
+    hedge_budget = get_hedge_budget(cfg) if hedge else None
+    budget = tracker.batch_budget(
+        n_images, int(concurrency.window), BATCH_DEADLINE_SECONDS
+    )
+    if limiter is not None:
+        # 限流排隊的時間不應算作上游變慢
+        budget = min(BATCH_DEADLINE_SECONDS, budget + limiter.expected_delay(n_images))
+    # 模型冷啟動的加載時間同理
+    budget = min(BATCH_DEADLINE_SECONDS, budget + get_model_warmup().remaining_load(cfg, model))
+    deadline = time.monotonic() + budget
+    
+    # 各圖片的下載進度：index -> (已下載字節, 預期字節)
+    downloads = {}
+    downloads_lock = threading.Lock()
+    
+    def make_context(index: int) -> RequestContext:
+        def on_progress(downloaded: int, expected: int):
+            with downloads_lock:
+                downloads[index] = (downloaded, expected)
+        return RequestContext(deadline, on_progress, reporter.cancelled)
+    
+    def limited_request(index: int, on_wire: Optional[Dict] = None) -> str:
+        if reporter.cancelled():
+            raise RequestCancelled()
+        # 依次取得限流令牌、併發窗口和排程名額，等待期間不佔用全局排程名額
+        if limiter is not None:
+            limiter.acquire(deadline, reporter.cancelled)
+        
+        def send() -> str:
+            # on_wire 記錄請求實際發往上游的時間，供對沖計時
+            if on_wire is not None:
+                on_wire["since"] = time.monotonic()
+            try:
+                return request_fn(index, make_context(index))
+            finally:
+                if on_wire is not None:
+                    on_wire["since"] = None
+        
+        return concurrency.run(lambda: scheduler.run(
+            reporter.owner, send, 1, deadline, reporter.cancelled
+        ), deadline, reporter.cancelled)
+    
+    def retried_request(index: int, on_wire: Optional[Dict] = None) -> str:
+        # 重試退避期間釋放併發名額
+        return call_with_retry(lambda: limited_request(index, on_wire), provider, deadline, breaker, reporter.cancelled)
+    
+    def hedged_request(index: int) -> str:
+        # 超過 p90 延遲仍未返回時發出一次相同參數的備份請求，採用先成功者
+        delay = tracker.percentile("total", HEDGE_PERCENTILE)
+        hedge_budget.deposit()
+        if delay is None:
+            return retried_request(index)
+        
+        executor = get_hedge_executor()
+        on_wire = {"since": None}
+        primary = executor.submit(retried_request, index, on_wire)
+        # 從主請求實際發往上游時開始計時；排隊、限流和重試退避期間不對沖
+        threshold = max(HEDGE_MIN_DELAY, delay)
+        while True:
+            since = on_wire["since"]
+            timeout = HEDGE_POLL_INTERVAL if since is None else max(0.0, since + threshold - time.monotonic())
+            if wait([primary], timeout=timeout).done:
+                return primary.result()
+            if since is not None and on_wire["since"] == since and time.monotonic() >= since + threshold:
+                break
+        # 熔斷器未閉合時只允許探測請求，不對沖
+        if breaker.current_state() != CircuitBreaker.CLOSED or not hedge_budget.withdraw():
+            return primary.result()
+        
+        # 備份請求只嘗試一次，結果同樣計入熔斷器；落後的請求無法中斷，其結果直接丟棄
+        backup = executor.submit(call_with_retry, lambda: limited_request(index), provider, deadline,
+                                 breaker, reporter.cancelled, 1)
+        pending = {primary, backup}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        hedge_budget.record_win()
+                    return future.result()
+        return primary.result()
+    
+    attempt_fn = hedged_request if hedge_budget is not None else retried_request
+    
+    def task(index: int) -> str:
+        # 等待合併結果的調用不佔用供應商併發名額
+        if flight_key_fn is None:
+            return attempt_fn(index)
+        return flights.do(flight_key_fn(index), lambda: attempt_fn(index))
+    
+    # 每張圖片一個執行緒，排隊和退避等待不佔用共享執行緒
+    executor = ThreadPoolExecutor(max_workers=max(1, n_images), thread_name_prefix="batch")
+    futures = {executor.submit(task, i): i for i in range(n_images)}
+    executor.shutdown(wait=False)
+    results = [None] * n_images
+    completed = 0
+    pending = set(futures)
+    
+    while pending:
+        done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+        
+        for future in done:
+            i = futures[future]
+            completed += 1
+            
+            try:
+                results[i] = future.result()
+                reporter.report_image(i, results[i])
+            except GenerationError as e:
+                reporter.report_failure(i, f"第 {i+1} 張圖片生成失敗: {e}")
+            except Exception as e:
+                reporter.report_failure(i, f"第 {i+1} 張圖片生成錯誤: {str(e)[:100]}")
+        
+        # 按實際下載字節計算進行中圖片的進度
+        with downloads_lock:
+            in_flight = [downloads[futures[f]] for f in pending if futures[f] in downloads]
+            total_bytes = sum(downloaded for downloaded, _ in downloads.values())
+        partial = sum(min(1.0, downloaded / expected) for downloaded, expected in in_flight if expected)
+        
+        reporter.report_progress(completed, n_images, min(1.0, (completed + partial) / n_images), total_bytes)
+    
+    return [(i, blob_id) for i, blob_id in enumerate(results) if blob_id is not None]
+
+# === 重試策略 ===
+
+class RetryMetrics:
+    """按供應商統計請求嘗試、重試與放棄次數"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+    
+    def record(self, provider: str, event: str, amount: float = 1):
+        with self._lock:
+            counters = self._counters.setdefault(provider, {
+                "attempts": 0, "retries": 0, "successes": 0, "giveups": 0, "backoff_seconds": 0.0
+            })
+            counters[event] += amount
+    
+    def snapshot(self, provider: str) -> Dict:
+        with self._lock:
+            return dict(self._counters.get(provider, {
+                "attempts": 0, "retries": 0, "successes": 0, "giveups": 0, "backoff_seconds": 0.0
+            }))
+
+@st.cache_resource
+def get_retry_metrics() -> RetryMetrics:
+    """獲取進程級重試統計"""
+    return RetryMetrics()
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 頭（秒數或 HTTP 日期）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def get_retry_policy(provider: str, status_code: Optional[int] = None) -> Dict:
+    """合併默認策略、供應商策略和狀態碼覆蓋規則"""
+    provider_policy = RETRY_POLICIES.get(provider, {})
+    policy = {**RETRY_POLICIES["default"], **provider_policy}
+    
+    overrides = {
+        **RETRY_POLICIES["default"].get("status_overrides", {}),
+        **provider_policy.get("status_overrides", {}),
+    }
+    if status_code in overrides:
+        policy.update(overrides[status_code])
+    
+    return policy
+
+def classify_error(error: Exception) -> Tuple[bool, Optional[int], Optional[float]]:
+    """判斷錯誤類型，返回 (是否暫時性錯誤, 狀態碼, Retry-After 秒數)"""
+    if isinstance(error, GenerationError):
+        return error.status_code is not None, error.status_code, error.retry_after
+    if isinstance(error, APIStatusError):
+        retry_after = parse_retry_after(error.response.headers.get("Retry-After"))
+        return True, error.status_code, retry_after
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                          APITimeoutError, APIConnectionError)):
+        return True, None, None
+    return False, None, None
+
+def call_with_retry(fn, provider: str, deadline: Optional[float] = None,
+                    breaker: Optional["CircuitBreaker"] = None, cancelled=None,
+                    max_attempts: Optional[int] = None):
+    """按重試策略執行 fn：指數退避 + 完全抖動，並遵循 Retry-After、批次時限與取消標記（max_attempts 覆蓋策略的嘗試次數）"""
+    metrics = get_retry_metrics()
+    attempt = 0
+    
+    while True:
+        attempt += 1
+        if cancelled is not None and cancelled():
+            raise RequestCancelled()
+        
+        # 熔斷器斷開時快速失敗，不再重試
+        if breaker is not None:
+            breaker.before_call()
+        metrics.record(provider, "attempts")
+        
+        try:
+            result = fn()
+            metrics.record(provider, "successes")
+            if breaker is not None:
+                breaker.record_success()
+            return result
+        except Exception as e:
+            if isinstance(e, RequestCancelled):
+                if breaker is not None:
+                    breaker.release_probe()
+                raise
+            transient, status_code, retry_after = classify_error(e)
+            if breaker is not None:
+                if is_upstream_failure(e, status_code):
+                    breaker.record_failure()
+                elif status_code is not None:
+                    # 上游有響應（如參數錯誤、限流）說明服務可用
+                    breaker.record_success()
+                else:
+                    breaker.release_probe()
+            policy = get_retry_policy(provider, status_code)
+            
+            retryable = transient and (status_code is None or status_code in policy["retry_statuses"])
+            if not retryable or attempt >= (max_attempts or policy["max_attempts"]):
+                metrics.record(provider, "giveups")
+                raise
+            
+            if retry_after is not None:
+                delay = retry_after
+            else:
+                delay = random.uniform(0, min(policy["max_delay"], policy["base_delay"] * 2 ** (attempt - 1)))
+            
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                if not isinstance(e, ModelLoadingError):
+                    metrics.record(provider, "giveups")
+                    raise
+                # 等不及預計加載時間時立即重試，由服務端保持連接直到加載完成
+                delay = 0.0
+            
+            metrics.record(provider, "retries")
+            metrics.record(provider, "backoff_seconds", delay)
+            sleep_unless_cancelled(delay, cancelled)
+
+# === 自適應超時 ===
+
+class LatencyTracker:
+    """滾動記錄單個 (供應商, 模型) 的延遲樣本，並據此推導超時"""
+    
+    def __init__(self, window: int):
+        self._lock = threading.Lock()
+        self._samples = {
+            "ttfb": deque(maxlen=window),  # 發出請求到收到響應頭（即生成耗時）
+            "transfer": deque(maxlen=window),  # 響應體下載耗時
+            "total": deque(maxlen=window),
+        }
+    
+    def record(self, ttfb: float, total: float):
+        with self._lock:
+            self._samples["ttfb"].append(ttfb)
+            self._samples["transfer"].append(max(0.0, total - ttfb))
+            self._samples["total"].append(total)
+    
+    def record_timeout(self, waited: float):
+        """超時按已等待時間計入樣本，避免慢模型因超時過短而持續失敗"""
+        with self._lock:
+            self._samples["ttfb"].append(waited)
+            self._samples["total"].append(waited)
+    
+    def percentile(self, name: str, q: float) -> Optional[float]:
+        """返回指定樣本序列的百分位數，樣本不足時返回 None"""
+        with self._lock:
+            samples = sorted(self._samples[name])
+        if len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        return samples[max(0, math.ceil(q * len(samples)) - 1)]
+    
+    def timeouts(self, ceiling: float) -> Dict[str, float]:
+        """推導連接/讀取超時和下載停滯閾值"""
+        p95_ttfb = self.percentile("ttfb", 0.95)
+        read = ceiling if p95_ttfb is None else min(ceiling, max(MIN_READ_TIMEOUT, p95_ttfb * TIMEOUT_MULTIPLIER))
+        
+        p95_transfer = self.percentile("transfer", 0.95)
+        stall = STALL_TIMEOUT_MAX if p95_transfer is None else min(
+            STALL_TIMEOUT_MAX, max(STALL_TIMEOUT_MIN, p95_transfer * TIMEOUT_MULTIPLIER)
+        )
+        
+        return {"connect": min(CONNECT_TIMEOUT, read), "read": read, "stall": stall}
+    
+    def batch_budget(self, n_images: int, concurrency: int, ceiling: float) -> float:
+        """按 p99 延遲和併發輪數估算批次時限（預留一輪重試）"""
+        p99_total = self.percentile("total", 0.99)
+        if p99_total is None:
+            return ceiling
+        waves = math.ceil(n_images / max(1, concurrency)) + 1
+        return min(ceiling, max(MIN_BATCH_BUDGET, p99_total * TIMEOUT_MULTIPLIER * waves))
+
+@st.cache_resource
+def get_latency_registry() -> Dict:
+    """獲取進程級延遲統計註冊表"""
+    return {"lock": threading.Lock(), "trackers": {}}
+
+def get_latency_tracker(provider: str, model: Optional[str]) -> LatencyTracker:
+    """獲取指定供應商和模型的延遲統計"""
+    key = (provider, model)
+    registry = get_latency_registry()
+    
+    with registry["lock"]:
+        if key not in registry["trackers"]:
+            registry["trackers"][key] = LatencyTracker(LATENCY_WINDOW)
+        return registry["trackers"][key]
+
+def resolve_timeouts(cfg: Dict, model: Optional[str], deadline: Optional[float],
+                     extra_wait: float = 0.0) -> Dict[str, float]:
+    """計算本次請求的超時（extra_wait 為服務端預計的額外等待），讀取超時不超過批次剩餘時間"""
+    ceiling = float(cfg.get('timeout_ceiling') or REQUEST_TIMEOUT)
+    timeouts = get_latency_tracker(cfg.get('provider'), model).timeouts(ceiling)
+    timeouts["read"] += extra_wait
+    
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise GenerationError("批次已超過時限")
+        timeouts["read"] = min(timeouts["read"], remaining)
+        timeouts["connect"] = min(timeouts["connect"], remaining)
+    
+    return timeouts
+
+def apply_stall_timeout(response, stall_timeout: float):
+    """響應頭到達後，將底層套接字的讀取超時縮短為停滯閾值"""
+    connection = getattr(getattr(response, "raw", None), "connection", None)
+    sock = getattr(connection, "sock", None)
+    if sock is not None:
+        sock.settimeout(stall_timeout)
+
+def fetch_image(transport: HttpTransport, method: str, url: str, tracker: LatencyTracker,
+                timeouts: Dict[str, float], ctx: Optional[RequestContext] = None,
+                record_latency: bool = True, **kwargs) -> str:
+    """發送圖片請求並將響應體分塊寫入文件存儲，返回圖片文件 ID（record_latency 為 False 時不計入延遲樣本）"""
+    watcher = get_cancel_watcher()
+    if ctx is not None:
+        if ctx.cancelled():
+            raise RequestCancelled()
+        watcher.add(ctx)
+    try:
+        return download_image(transport, method, url, tracker, timeouts, ctx, record_latency, **kwargs)
+    except (requests.exceptions.RequestException, GenerationError) as e:
+        # 取消時連接被監視器關閉，統一轉為取消錯誤（不重試、不計入熔斷）
+        if ctx is not None and ctx.cancelled() and not isinstance(e, RequestCancelled):
+            raise RequestCancelled() from e
+        raise
+    finally:
+        if ctx is not None:
+            watcher.discard(ctx)
+
+def download_image(transport: HttpTransport, method: str, url: str, tracker: LatencyTracker,
+                   timeouts: Dict[str, float], ctx: Optional[RequestContext], record_latency: bool, **kwargs) -> str:
+    """fetch_image 的實際請求與下載，連接登記到 ctx 以便取消"""
+    started = time.monotonic()
+    active_request = get_active_request()
+    active_request.ctx = ctx
+    try:
+        response = transport.request(
+            method, url, stream=True, timeout=(timeouts["connect"], timeouts["read"]), **kwargs
+        )
+    except requests.exceptions.Timeout:
+        tracker.record_timeout(time.monotonic() - started)
+        raise
+    finally:
+        active_request.ctx = None
+    
+    headers_at = time.monotonic()
+    try:
+        raise_for_generation_status(response)
+        
+        expected = int(response.headers.get("Content-Length") or 0)
+        if expected > MAX_IMAGE_BYTES:
+            raise GenerationError(f"圖片大小 {expected} bytes 超過上限 {MAX_IMAGE_BYTES} bytes")
+        
+        def on_chunk(downloaded: int):
+            if ctx is not None:
+                if ctx.cancelled():
+                    raise RequestCancelled()
+                ctx.report_progress(downloaded, expected)
+        
+        # 響應體下載期間任意兩個數據塊之間的間隔不得超過停滯閾值
+        apply_stall_timeout(response, timeouts["stall"])
+        try:
+            blob_id = get_blob_store().write_stream(response.iter_content(IMAGE_CHUNK_SIZE), on_chunk)
+        except requests.exceptions.ConnectionError as e:
+            if e.args and isinstance(e.args[0], ReadTimeoutError):
+                raise requests.exceptions.Timeout(f"下載停滯超過 {timeouts['stall']:.0f} 秒") from e
+            raise
+    finally:
+        if ctx is not None:
+            # 先解除登記再歸還連接，避免監視器關閉已回到連接池的連接
+            ctx.detach()
+        response.close()
+    
+    if record_latency:
+        tracker.record(headers_at - started, time.monotonic() - started)
+    return blob_id
+
+# === 熔斷器 ===
+
+class CircuitOpenError(GenerationError):
+    """熔斷器斷開時的快速失敗"""
+
+class CircuitBreaker:
+    """單個 (存檔, 模型) 的熔斷器：閉合 → 斷開 → 半開探測 → 閉合"""
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+    
+    def before_call(self):
+        """檢查是否允許發出請求；半開狀態下只放行一個探測請求"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"熔斷器已斷開，約 {self.seconds_until_probe():.0f} 秒後重試")
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    raise CircuitOpenError("熔斷器半開，正在等待探測請求結果")
+                self._probe_in_flight = True
+    
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+    
+    def release_probe(self):
+        """未觸達上游的錯誤不改變狀態，只釋放探測名額"""
+        with self._lock:
+            self._probe_in_flight = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+    
+    def seconds_until_probe(self) -> float:
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+    
+    def current_state(self) -> str:
+        """返回當前狀態（斷開超時後顯示為半開）"""
+        with self._lock:
+            if self.state == self.OPEN and self.seconds_until_probe() == 0:
+                return self.HALF_OPEN
+            return self.state
+
+@st.cache_resource
+def get_circuit_registry() -> Dict:
+    """獲取進程級熔斷器註冊表"""
+    return {"lock": threading.Lock(), "breakers": {}}
+
+def endpoint_key(cfg: Dict) -> str:
+    """存檔的進程內唯一標識：供應商 + 端點 + 憑證指紋"""
+    return f"{cfg.get('provider')}|{str(cfg.get('base_url', '')).rstrip('/')}|{credential_fingerprint(cfg)}"
+
+def get_circuit_breaker(cfg: Dict, model: Optional[str]) -> CircuitBreaker:
+    """獲取指定存檔和模型的熔斷器"""
+    key = (endpoint_key(cfg), model)
+    registry = get_circuit_registry()
+    
+    with registry["lock"]:
+        if key not in registry["breakers"]:
+            registry["breakers"][key] = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        return registry["breakers"][key]
+
+def is_upstream_failure(error: Exception, status_code: Optional[int]) -> bool:
+    """判斷錯誤是否表示上游不可用（超時、連接失敗、5xx），模型冷啟動除外"""
+    if isinstance(error, ModelLoadingError):
+        return False
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                          APITimeoutError, APIConnectionError)):
+        return True
+    return status_code is not None and status_code >= 500
+
+# === 速率限制 ===
+
+class RateLimitExceeded(GenerationError):
+    """等待限流令牌會超過批次時限"""
+
+class TokenBucket:
+    """令牌桶限流器：請求預約令牌並等待，而不是直接發出後收到 429"""
+    
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.stats = {"acquired": 0, "waited": 0, "wait_seconds": 0.0, "max_wait": 0.0}
+    
+    def acquire(self, deadline: Optional[float] = None, cancelled=None) -> float:
+        """預約一個令牌並等待其可用，返回實際等待秒數"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait_seconds = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            
+            if deadline is not None and now + wait_seconds > deadline:
+                # 歸還預約，讓後續請求不必為此次放棄等待
+                self._tokens += 1
+                raise RateLimitExceeded(f"限流等待 {wait_seconds:.0f} 秒將超過批次時限")
+            
+            self.stats["acquired"] += 1
+            if wait_seconds > 0:
+                self.stats["waited"] += 1
+                self.stats["wait_seconds"] += wait_seconds
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait_seconds)
+        
+        if wait_seconds > 0:
+            try:
+                sleep_unless_cancelled(wait_seconds, cancelled)
+            except RequestCancelled:
+                with self._lock:
+                    self._tokens += 1
+                raise
+        return wait_seconds
+    
+    def expected_delay(self, count: int) -> float:
+        """估算再取得 count 個令牌需要等待的秒數，用於放寬批次時限"""
+        with self._lock:
+            tokens = min(self.burst, self._tokens + (time.monotonic() - self._updated) * self.rate)
+            return max(0.0, (count - tokens) / self.rate)
+    
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {"rate": self.rate, "burst": self.burst, **self.stats}
+
+@st.cache_resource
+def get_rate_limit_registry() -> Dict:
+    """獲取令牌桶註冊表，並載入 secrets 中的限流配置"""
+    try:
+        settings = st.secrets.get("rate_limits", {})
+    except StreamlitSecretNotFoundError:
+        settings = {}
+    return {"lock": threading.Lock(), "buckets": {}, "settings": settings}
+
+def rate_limit_mode(cfg: Dict) -> str:
+    """存檔實際生效的認證模式（令牌或域名缺失時按免費計算）"""
+    if cfg.get('provider') == "Pollinations.ai":
+        mode = cfg.get('pollinations_auth_mode', '免費')
+        if (mode == '令牌' and cfg.get('pollinations_token')) or \
+           (mode == '域名' and cfg.get('pollinations_referrer')):
+            return mode
+        return '免費'
+    return '*'
+
+def resolve_rate_limit(provider: str, mode: str, settings: Dict) -> Optional[Dict]:
+    """合併默認值與 secrets 配置，返回 {rate, burst}；不限流時返回 None"""
+    limits = dict(DEFAULT_RATE_LIMITS.get(provider, {}).get(mode) or
+                  DEFAULT_RATE_LIMITS.get(provider, {}).get('*') or {})
+    
+    provider_settings = settings.get(provider, {})
+    mode_settings = provider_settings.get(mode) if mode != '*' else None
+    for source in (provider_settings, mode_settings or {}):
+        limits.update({k: source[k] for k in ("rate", "burst") if k in source})
+    
+    try:
+        rate = float(limits.get("rate") or 0)
+        burst = float(limits.get("burst") or 1)
+    except (TypeError, ValueError):
+        return None
+    return {"rate": rate, "burst": burst} if rate > 0 else None
+
+def get_rate_limiter(cfg: Dict) -> Optional[TokenBucket]:
+    """獲取存檔 + 認證模式對應的令牌桶，未配置限流時返回 None"""
+    registry = get_rate_limit_registry()
+    provider = cfg.get('provider')
+    mode = rate_limit_mode(cfg)
+    limits = resolve_rate_limit(provider, mode, registry["settings"])
+    if limits is None:
+        return None
+    
+    if mode == '免費':
+        # 匿名配額按來源 IP 計算，所有免費存檔共享同一個桶
+        key = (provider, str(cfg.get('base_url', '')).rstrip('/'), mode)
+    else:
+        key = (endpoint_key(cfg), mode)
+    
+    with registry["lock"]:
+        bucket = registry["buckets"].get(key)
+        if bucket is None or (bucket.rate, bucket.burst) != (limits["rate"], max(1.0, limits["burst"])):
+            bucket = registry["buckets"][key] = TokenBucket(limits["rate"], limits["burst"])
+        return bucket
+
+# === 智能路由 ===
+
+class RouteStats:
+    """按 (存檔, 模型) 記錄批次成功率的指數移動平均"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates: Dict[Tuple[str, str], float] = {}
+    
+    def record(self, cfg: Dict, model: str, requested: int, produced: int):
+        key = (endpoint_key(cfg), model)
+        with self._lock:
+            rate = self._rates.get(key, ROUTING_SUCCESS_PRIOR)
+            self._rates[key] = (1 - ROUTING_SUCCESS_ALPHA) * rate + ROUTING_SUCCESS_ALPHA * produced / max(1, requested)
+    
+    def success_rate(self, cfg: Dict, model: str) -> float:
+        with self._lock:
+            return self._rates.get((endpoint_key(cfg), model), ROUTING_SUCCESS_PRIOR)
+
+@st.cache_resource
+def get_route_stats() -> RouteStats:
+    """獲取進程級路由成功率統計"""
+    return RouteStats()
+
+def get_cost_per_image(cfg: Dict) -> float:
+    """存檔配置的單張成本，未配置時按供應商默認值"""
+    try:
+        return float(cfg.get('cost_per_image', DEFAULT_COST_PER_IMAGE.get(cfg.get('provider'), 0.0)))
+    except (TypeError, ValueError):
+        return 0.0
+
+def score_route(cfg: Dict, model: str) -> Optional[float]:
+    """為 (存檔, 模型) 評分，越高越優先；熔斷器斷開時返回 None"""
+    if get_circuit_breaker(cfg, model).current_state() == CircuitBreaker.OPEN:
+        return None
+    
+    p95 = get_latency_tracker(cfg.get('provider'), model).percentile("total", 0.95)
+    # 加載中的模型還需等待其剩餘加載時間
+    latency = (p95 if p95 is not None else ROUTING_LATENCY_REF) + get_model_warmup().remaining_load(cfg, model)
+    limiter = get_rate_limiter(cfg)
+    quota_wait = limiter.expected_delay(1) if limiter is not None else 0.0
+    cost = get_cost_per_image(cfg)
+    
+    weights = ROUTING_WEIGHTS
+    return (weights["success"] * get_route_stats().success_rate(cfg, model)
+            - weights["latency"] * latency / (latency + ROUTING_LATENCY_REF)
+            - weights["quota"] * quota_wait / (quota_wait + ROUTING_QUOTA_REF)
+            - weights["cost"] * cost / (cost + ROUTING_COST_REF))
+
+def rank_routes(entries: List[Tuple]) -> List[Tuple[Tuple, Optional[float]]]:
+    """按評分排序候選 (存檔名, 配置, 模型, 客戶端)，熔斷中的存檔排在最後作為兜底"""
+    scored = [(entry, score_route(entry[1], entry[2])) for entry in entries]
+    return sorted(scored, key=lambda item: (item[1] is not None, item[1] or 0.0), reverse=True)
+
+# === 模型冷啟動與預熱 ===
+
+class ModelWarmup:
+    """記錄各 (存檔, 模型) 的加載狀態和最近使用時間，在後台預熱選中的模型並為近期使用的模型保溫"""
+    
+    def __init__(self, keep_warm_seconds: float):
+        self.keep_warm_seconds = keep_warm_seconds
+        self.stats = {"cold_starts": 0, "warmups": 0}
+        self._lock = threading.Lock()
+        self._models: Dict[Tuple[str, str], Dict] = {}
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="warmup")
+    
+    def _entry(self, cfg: Dict, model: str) -> Dict:
+        return self._models.setdefault((endpoint_key(cfg), model), {
+            "cfg": dict(cfg), "model": model, "loading_since": None, "loading_until": 0.0,
+            "warm_at": None, "failed_at": None, "last_used": None,
+        })
+    
+    def _is_loading(self, entry: Dict, now: float) -> bool:
+        # 超過加載上限仍未成功時放棄等待，按未知狀態處理
+        return entry["loading_since"] is not None and now - entry["loading_since"] < HF_MAX_LOAD_WAIT
+    
+    def mark_loading(self, cfg: Dict, model: str, estimated_time: float):
+        """記錄模型正在加載及預計完成時間"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(cfg, model)
+            if not self._is_loading(entry, now):
+                entry["loading_since"] = now
+                self.stats["cold_starts"] += 1
+            entry["loading_until"] = now + min(estimated_time, HF_MAX_LOAD_WAIT)
+    
+    def mark_ready(self, cfg: Dict, model: str):
+        """記錄模型已成功響應"""
+        with self._lock:
+            entry = self._entry(cfg, model)
+            entry["loading_since"] = None
+            entry["failed_at"] = None
+            entry["warm_at"] = time.monotonic()
+    
+    def mark_failed(self, cfg: Dict, model: str):
+        """記錄預熱失敗，退避期間不再預熱"""
+        with self._lock:
+            self._entry(cfg, model)["failed_at"] = time.monotonic()
+    
+    def mark_used(self, cfg: Dict, model: str):
+        """記錄模型被用於生成（保溫的依據）"""
+        with self._lock:
+            entry = self._entry(cfg, model)
+            entry["cfg"] = dict(cfg)
+            entry["last_used"] = time.monotonic()
+    
+    def loading_wait(self, cfg: Dict, model: str) -> Optional[float]:
+        """模型加載中時返回請求應額外等待的秒數，否則返回 None"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._models.get((endpoint_key(cfg), model))
+            if entry is None or not self._is_loading(entry, now):
+                return None
+            return max(0.0, entry["loading_until"] - now) + HF_LOAD_GRACE
+    
+    def remaining_load(self, cfg: Dict, model: str) -> float:
+        """預計的剩餘加載秒數（未在加載時為 0）"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._models.get((endpoint_key(cfg), model))
+            if entry is None or not self._is_loading(entry, now):
+                return 0.0
+            return max(0.0, entry["loading_until"] - now)
+    
+    def state(self, cfg: Dict, model: str) -> str:
+        """返回 loading / warm / unknown"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._models.get((endpoint_key(cfg), model))
+            if entry is None:
+                return "unknown"
+            if self._is_loading(entry, now):
+                return "loading"
+            if entry["warm_at"] is not None and now - entry["warm_at"] < HF_WARM_SECONDS:
+                return "warm"
+            return "unknown"
+    
+    def prewarm(self, cfg: Dict, model: str, min_interval: float = HF_WARM_SECONDS) -> bool:
+        """在後台發送預熱請求；預計加載未完成、最近已預熱、預熱失敗退避中或已有預熱進行中時跳過"""
+        key = (endpoint_key(cfg), model)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(cfg, model)
+            # 加載中時等到預計完成後再探測
+            if key in self._pending or (self._is_loading(entry, now) and entry["loading_until"] > now):
+                return False
+            if entry["warm_at"] is not None and now - entry["warm_at"] < min_interval:
+                return False
+            if entry["failed_at"] is not None and now - entry["failed_at"] < WARMUP_FAILURE_BACKOFF:
+                return False
+            self._pending.add(key)
+            self.stats["warmups"] += 1
+        self._executor.submit(self._warm, key, dict(cfg), model)
+        return True
+    
+    def _warm(self, key: Tuple[str, str], cfg: Dict, model: str):
+        try:
+            warm_huggingface_model(cfg, model)
+            self.mark_ready(cfg, model)
+        except ModelLoadingError as e:
+            self.mark_loading(cfg, model, e.estimated_time)
+        except Exception:
+            # 預熱只是優化，失敗時退避一段時間，由真實請求處理
+            self.mark_failed(cfg, model)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+    
+    def keep_warm_loop(self):
+        """後台保溫：定期為最近使用過、已有一段時間沒有請求的模型發送預熱請求"""
+        while True:
+            time.sleep(KEEP_WARM_CHECK_INTERVAL)
+            now = time.monotonic()
+            with self._lock:
+                due = [(entry["cfg"], entry["model"]) for entry in self._models.values()
+                       if entry["last_used"] is not None and now - entry["last_used"] < self.keep_warm_seconds]
+            for cfg, model in due:
+                self.prewarm(cfg, model, min_interval=KEEP_WARM_INTERVAL)
+    
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self.stats)
+
+@st.cache_resource
+def get_model_warmup() -> ModelWarmup:
+    """獲取進程級模型預熱管理器，並按 secrets [huggingface] keep_warm_minutes 啟動保溫執行緒"""
+    try:
+        settings = st.secrets.get("huggingface", {})
+    except StreamlitSecretNotFoundError:
+        settings = {}
+    
+    minutes = float(settings.get("keep_warm_minutes", KEEP_WARM_MINUTES))
+    warmup = ModelWarmup(minutes * 60)
+    if minutes > 0:
+        threading.Thread(target=warmup.keep_warm_loop, name="keep-warm", daemon=True).start()
+    return warmup
+
+def warm_huggingface_model(cfg: Dict, model: str):
+    """發送最小的生成請求觸發模型加載；加載中時拋出 ModelLoadingError"""
+    url = f"{cfg['base_url']}/models/{model}"
+    
+    def request():
+        response = get_http_transport(cfg['base_url'], cfg).request(
+            "POST", url, timeout=(CONNECT_TIMEOUT, REQUEST_TIMEOUT),
+            headers={"Authorization": f"Bearer {cfg['api_key']}"},
+            json={"inputs": "warmup", "parameters": dict(HF_WARMUP_PARAMETERS)}
+        )
+        try:
+            raise_for_generation_status(response)
+        finally:
+            response.close()
+    
+    # 與生成請求共用限流令牌和熔斷器，只嘗試一次
+    limiter = get_rate_limiter(cfg)
+    if limiter is not None:
+        limiter.acquire(time.monotonic() + WARMUP_MAX_QUEUE)
+    call_with_retry(request, cfg.get('provider'), breaker=get_circuit_breaker(cfg, model), max_attempts=1)
+
+# === 模型發現快取 ===
+
+def discovery_key(cfg: Dict) -> Tuple[str, str, str]:
+    """模型發現快取鍵：相同端點和憑證的存檔共享發現結果"""
+    return (cfg.get('provider', ''), cfg.get('base_url', '').rstrip('/'), credential_fingerprint(cfg))
+
+class ModelDiscovery:
+    """進程級模型發現快取：過期後以 If-None-Match 在後台重新驗證，期間繼續提供舊結果"""
+    
+    def __init__(self):
+        self.stats = {"fetches": 0, "not_modified": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str, str], Dict] = {}
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="discovery")
+    
+    def get(self, cfg: Dict) -> Dict[str, Dict]:
+        """立即返回已發現的模型（可能已過期，從未成功發現時為空），需要時在後台刷新"""
+        key = discovery_key(cfg)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None or now >= entry["next_refresh"]) and key not in self._pending:
+                self._pending.add(key)
+                self._executor.submit(self._refresh_in_background, key, dict(cfg))
+            if entry is None or now - entry["fetched_at"] > DISCOVERY_MAX_STALE_SECONDS:
+                return {}
+            return entry["models"]
+    
+    def status(self, cfg: Dict) -> Optional[Dict]:
+        """返回快取條目的狀態（模型數、更新時間、最近錯誤），未發現過時為 None"""
+        with self._lock:
+            entry = self._entries.get(discovery_key(cfg))
+            return dict(entry, count=len(entry["models"])) if entry else None
+    
+    def refresh(self, cfg: Dict, timeout: float = DISCOVERY_TIMEOUT) -> Dict:
+        """立即重新驗證並返回條目狀態；並發的相同刷新只發出一次請求"""
+        key = discovery_key(cfg)
+        get_single_flight().do(f"discovery:{':'.join(key)}", lambda: self._revalidate(key, cfg, timeout))
+        return self.status(cfg)
+    
+    def _refresh_in_background(self, key: Tuple[str, str, str], cfg: Dict):
+        try:
+            get_single_flight().do(f"discovery:{':'.join(key)}", lambda: self._revalidate(key, cfg))
+        except Exception:
+            # 錯誤已記錄在條目中，繼續使用舊結果
+            pass
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+    
+    def _revalidate(self, key: Tuple[str, str, str], cfg: Dict, timeout: float = DISCOVERY_TIMEOUT):
+        with self._lock:
+            entry = self._entries.get(key)
+            etag = entry["etag"] if entry and entry["models"] else None
+        
+        try:
+            model_ids, etag = fetch_model_ids(cfg, etag, timeout)
+        except Exception as e:
+            with self._lock:
+                self.stats["errors"] += 1
+                entry = self._entries.setdefault(key, {"models": {}, "etag": None, "fetched_at": 0.0})
+                entry.update(error=str(e)[:100], not_modified=False,
+                             next_refresh=time.time() + DISCOVERY_RETRY_SECONDS)
+            raise
+        
+        now = time.time()
+        with self._lock:
+            if model_ids is None:
+                self.stats["not_modified"] += 1
+                entry = self._entries[key]
+            else:
+                self.stats["fetches"] += 1
+                entry = {"models": build_discovered_models(cfg.get('provider', ''), model_ids)}
+                self._entries[key] = entry
+            entry.update(etag=etag, fetched_at=now, next_refresh=now + DISCOVERY_TTL_SECONDS,
+                         error=None, not_modified=model_ids is None)
+    
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self.stats)
+
+@st.cache_resource
+def get_model_discovery() -> ModelDiscovery:
+    """獲取進程級共享的模型發現快取"""
+    return ModelDiscovery()
+
+# === 存檔健康檢查 ===
+
+class ProfileHealth:
+    """進程級存檔健康檢查：在後台並發驗證存檔並刷新其模型發現，按 (供應商, 端點, 憑證) 快取結果"""
+    
+    def __init__(self):
+        self.stats = {"checks": 0, "failures": 0}
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, str, str], Dict] = {}
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=HEALTH_CHECK_WORKERS, thread_name_prefix="health")
+    
+    def check(self, cfg: Dict, force: bool = False, pinned: bool = False) -> bool:
+        """在後台檢查存檔；已有檢查進行中或距上次檢查未滿間隔時跳過（force 時只跳過進行中的）"""
+        key = discovery_key(cfg)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.setdefault(key, {
+                "cfg": dict(cfg), "state": "unknown", "validated": None, "message": "", "checked_at": 0.0,
+                "last_seen": now, "pinned": False,
+            })
+            entry["pinned"] = entry["pinned"] or pinned
+            if key in self._pending or (not force and now - entry["checked_at"] < HEALTH_CHECK_INTERVAL):
+                return False
+            entry["cfg"] = dict(cfg)
+            self._pending.add(key)
+        self._executor.submit(self._check, key, dict(cfg))
+        return True
+    
+    def status(self, cfg: Dict) -> Dict:
+        """返回存檔的健康狀態（state 為 unknown/ok/degraded/failed，validated 為最近一次確定的驗證結果），並記錄最近被查看的時間"""
+        key = discovery_key(cfg)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return {"state": "unknown", "validated": None, "message": "", "checked_at": 0.0, "checking": False}
+            entry["last_seen"] = time.time()
+            return {"state": entry["state"], "validated": entry["validated"], "message": entry["message"],
+                    "checked_at": entry["checked_at"], "checking": key in self._pending}
+    
+    def _check(self, key: Tuple[str, str, str], cfg: Dict):
+        state, message, is_valid = "degraded", "檢查失敗", None
+        try:
+            is_valid, message = validate_api_key(cfg.get('api_key', ''), cfg.get('base_url', ''),
+                                                 cfg.get('provider', ''), timeout=HEALTH_CHECK_TIMEOUT)
+            # 只有憑證被明確拒絕才算失敗；超時、連接失敗和 5xx 沿用上次確定的驗證結果
+            state = {True: "ok", False: "failed"}.get(is_valid, "degraded")
+            if is_valid:
+                try:
+                    get_model_discovery().refresh(cfg, timeout=HEALTH_CHECK_TIMEOUT)
+                except Exception as e:
+                    # 驗證已通過，模型發現失敗不影響使用
+                    state, message = "degraded", f"模型發現失敗: {str(e)[:100]}"
+        finally:
+            with self._lock:
+                self.stats["checks"] += 1
+                if state == "failed":
+                    self.stats["failures"] += 1
+                entry = self._entries[key]
+                entry.update(state=state, message=message, checked_at=time.time())
+                if is_valid is not None:
+                    entry["validated"] = is_valid
+                self._pending.discard(key)
+    
+    def check_loop(self):
+        """定期重新檢查 secrets 中的存檔和近期有會話查看的存檔"""
+        while True:
+            time.sleep(HEALTH_LOOP_INTERVAL)
+            now = time.time()
+            with self._lock:
+                due = [entry["cfg"] for entry in self._entries.values()
+                       if entry["pinned"] or now - entry["last_seen"] < HEALTH_IDLE_SECONDS]
+            for cfg in due:
+                self.check(cfg)
+    
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return dict(self.stats)
+
+@st.cache_resource
+def get_profile_health() -> ProfileHealth:
+    """獲取進程級存檔健康檢查服務：啟動時並發檢查 secrets 中的所有存檔，並啟動定期檢查執行緒"""
+    health = ProfileHealth()
+    for cfg in load_base_profiles().values():
+        health.check(cfg, pinned=True)
+    threading.Thread(target=health.check_loop, name="profile-health", daemon=True).start()
+    return health
+
+def sync_profile_health():
+    """為本會話的存檔排程後台檢查，並按已確定的驗證結果更新其驗證狀態（不等待網絡請求）"""
+    health = get_profile_health()
+    for cfg in st.session_state.api_profiles.values():
+        health.check(cfg)
+        validated = health.status(cfg)["validated"]
+        if validated is not None:
+            cfg['validated'] = validated
+
+# === 圖片文件存儲 ===
+
+class BlobStore:
+    """內容尋址的圖片文件存儲：流式寫入、大小上限、按最近訪問淘汰"""
+    
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # blob_id -> 文件大小，按最近訪問排序
+        self._pins: Dict[str, float] = {}  # blob_id -> 保留到期時間，期間不被淘汰
+        self._total_bytes = 0
+        
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for filename in os.listdir(directory):
+            if filename.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(os.path.join(directory, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, filename, stat.st_size))
+        for _, blob_id, size in sorted(entries):
+            self._index[blob_id] = size
+            self._total_bytes += size
+    
+    def path(self, blob_id: str) -> str:
+        return os.path.join(self.directory, blob_id)
+    
+    def write_stream(self, chunks, on_progress=None) -> str:
+        """將數據塊流式寫入臨時文件，完成後按內容哈希原子落盤"""
+        digest = hashlib.sha256()
+        downloaded = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    downloaded += len(chunk)
+                    if downloaded > MAX_IMAGE_BYTES:
+                        raise GenerationError(f"圖片大小超過上限 {MAX_IMAGE_BYTES} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+                    if on_progress is not None:
+                        on_progress(downloaded)
+            
+            blob_id = digest.hexdigest()
+            os.replace(tmp_path, self.path(blob_id))
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        
+        self._register(blob_id, downloaded)
+        return blob_id
+    
+    def put_bytes(self, data: bytes) -> str:
+        """寫入內存中的圖片數據"""
+        return self.write_stream([data])
+    
+    def read(self, blob_id: str) -> Optional[bytes]:
+        """讀取圖片數據，文件已被淘汰時返回 None"""
+        try:
+            with open(self.path(blob_id), "rb") as f:
+                data = f.read()
+            os.utime(self.path(blob_id))
+        except OSError:
+            return None
+        
+        with self._lock:
+            if blob_id in self._index:
+                self._index.move_to_end(blob_id)
+        return data
+    
+    def pin(self, blob_ids: List[str], seconds: float = BLOB_PIN_SECONDS):
+        """在期限內保留圖片文件不被淘汰（用於收藏），重複調用會續期"""
+        until = time.time() + seconds
+        with self._lock:
+            for blob_id in blob_ids:
+                self._pins[blob_id] = max(self._pins.get(blob_id, 0.0), until)
+    
+    def _register(self, blob_id: str, size: int):
+        with self._lock:
+            self._total_bytes += size - self._index.pop(blob_id, 0)
+            self._index[blob_id] = size
+            if self._total_bytes <= self.max_bytes:
+                return
+            
+            now = time.time()
+            self._pins = {pinned: until for pinned, until in self._pins.items() if until > now}
+            # 按最近訪問順序淘汰，跳過剛寫入和被保留的文件
+            for victim in [b for b in self._index if b != blob_id and b not in self._pins]:
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._total_bytes -= self._index.pop(victim)
+                try:
+                    os.remove(self.path(victim))
+                except OSError:
+                    pass
+
+@st.cache_resource
+def get_blob_store() -> BlobStore:
+    """獲取進程級共享的圖片文件存儲"""
+    return BlobStore(BLOB_DIR, BLOB_MAX_BYTES)
+
+# === 生成結果快取 ===
+
+class GenerationCache:
+    """內容尋址的磁碟結果快取，支持 LRU/TTL 淘汰與原子寫入"""
+    
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._index = OrderedDict()  # key -> 文件大小，按最近訪問排序
+        self._total_bytes = 0
+        
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+    
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.bin")
+    
+    def _load_index(self):
+        """按修改時間（即最近訪問時間）重建索引"""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".bin"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, filename[:-4], stat.st_size))
+        
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+    
+    def _remove(self, key: str):
+        size = self._index.pop(key, 0)
+        self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+    
+    def get(self, key: str) -> Optional[Tuple[List[bytes], List[Dict]]]:
+        """讀取快取的圖片列表及每張圖片的元數據，未命中或已過期時返回 None"""
+        with self._lock:
+            if key not in self._index:
+                self.stats["misses"] += 1
+                return None
+            
+            try:
+                with open(self._path(key), "rb") as f:
+                    header = json.loads(f.readline())
+                    if time.time() - header["created"] > self.ttl:
+                        raise ValueError("expired")
+                    images = [f.read(size) for size in header["sizes"]]
+                    meta = header.get("meta") or [{} for _ in images]
+                os.utime(self._path(key))
+            except (OSError, ValueError, KeyError):
+                self._remove(key)
+                self.stats["misses"] += 1
+                return None
+            
+            self._index.move_to_end(key)
+            self.stats["hits"] += 1
+            return images, meta
+    
+    def put(self, key: str, images: List[bytes], meta: Optional[List[Dict]] = None):
+        """原子寫入一條快取記錄，並按 LRU 淘汰超出容量的記錄"""
+        header = json.dumps({
+            "created": time.time(),
+            "sizes": [len(img) for img in images],
+            "meta": meta or [{} for _ in images],
+        }, ensure_ascii=False, default=str)
+        
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header.encode() + b"\n")
+                for img in images:
+                    f.write(img)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        
+        size = os.path.getsize(self._path(key))
+        with self._lock:
+            self._total_bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+            self.stats["writes"] += 1
+            
+            while self._total_bytes > self.max_bytes and len(self._index) > 1:
+                oldest = next(iter(self._index))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+    
+    def clear(self):
+        """清空所有快取記錄"""
+        with self._lock:
+            for key in list(self._index):
+                self._remove(key)
+    
+    def summary(self) -> Dict:
+        """返回命中統計和容量信息"""
+        with self._lock:
+            return {**self.stats, "entries": len(self._index), "bytes": self._total_bytes}
+
+@st.cache_resource
+def get_generation_cache() -> GenerationCache:
+    """獲取進程級共享的生成結果快取"""
+    return GenerationCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL_SECONDS)
+
+def build_cache_key(cfg: Dict, params: Dict) -> str:
+    """根據規範化的請求參數計算快取鍵"""
+    normalized = {
+        "provider": cfg.get('provider'),
+        "base_url": str(cfg.get('base_url', '')).rstrip('/'),
+        **{k: v for k, v in params.items() if v is not None and v != ""},
+    }
+    normalized["prompt"] = " ".join(str(normalized.get("prompt", "")).split())
+    normalized["negative_prompt"] = " ".join(str(normalized.get("negative_prompt", "")).split())
+    
+    canonical = json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# === 圖像生成功能 ===
+
+def generate_images_with_retry(client, cfg: Dict, reporter: Optional[BatchReporter] = None,
+                               use_cache: bool = True, hedge: bool = False,
+                               race: Optional[List[Tuple]] = None, route: Optional[List[Tuple]] = None,
+                               **params) -> Tuple[bool, any]:
+    """統一的圖像生成入口（不依賴會話狀態，可在後台任務中執行）"""
+    reporter = reporter or BatchReporter()
+    provider = cfg.get('provider')
+    n_images = params.get("n", 1)
+    
+    # 查詢結果快取：未指定種子時每次生成都應得到新的隨機圖片，不查快取
+    cache = get_generation_cache()
+    cache_key = build_cache_key(cfg, params)
+    seeded = params.get("seed") is not None
+    blob_store = get_blob_store()
+    if use_cache and seeded and (cached := cache.get(cache_key)) is not None:
+        images = []
+        for i, (img, meta) in enumerate(zip(*cached)):
+            blob_id = blob_store.put_bytes(img)
+            images.append(type('Image', (object,), {
+                'blob_id': blob_id, 'seed': meta.get('seed'), 'params': meta.get('params', {})
+            }))
+            reporter.report_image(i, blob_id)
+        reporter.report_progress(len(images), n_images, 1.0, 0)
+        return True, type('Response', (object,), {'data': images, 'cached': True})
+    
+    if race:
+        # race 為額外參與競速的 (存檔名, 配置, 模型, 客戶端)，當前存檔以 None 為名
+        entries = [(None, cfg, params.get("model"), client)] + list(race)
+        success, result = generate_race(entries, params, n_images, reporter, hedge)
+    elif route:
+        # route 為包含當前存檔在內的全部候選 (存檔名, 配置, 模型, 客戶端)
+        success, result = generate_routed(route, params, n_images, reporter, hedge)
+    else:
+        success, result = dispatch_generation(client, cfg, params, n_images, reporter, hedge)
+    
+    # 只快取完整的批次；有種子的圖片另以單張請求的鍵快取，供「精確重現」直接命中
+    # 競速和路由的圖片按實際生成它的存檔和模型計算快取鍵
+    if success and len(result.data) == n_images:
+        cached_images = [blob_store.read(img.blob_id) for img in result.data]
+        if all(img is not None for img in cached_images):
+            metas = [{"seed": img.seed, "params": img.params} for img in result.data]
+            servers = [(getattr(img, 'served_cfg', cfg), getattr(img, 'served_model', params.get("model")))
+                       for img in result.data]
+            batch_key = None
+            if seeded and all(server == servers[0] for server in servers):
+                served_cfg, served_model = servers[0]
+                batch_key = build_cache_key(served_cfg, {**params, "model": served_model})
+                cache.put(batch_key, cached_images, metas)
+            for img, data, meta, (served_cfg, served_model) in zip(result.data, cached_images, metas, servers):
+                if img.seed is None:
+                    continue
+                exact_key = build_cache_key(served_cfg, {**params, "model": served_model, "n": 1, "seed": img.seed})
+                if exact_key != batch_key:
+                    cache.put(exact_key, [data], [meta])
+    
+    return success, result
+
+def dispatch_generation(client, cfg: Dict, params: Dict, n_images: int,
+                        reporter: BatchReporter, hedge: bool = False) -> Tuple[bool, any]:
+    """按供應商分派生成請求"""
+    provider = cfg.get('provider')
+    if provider == "Pollinations.ai":
+        return generate_pollinations_images(cfg, params, n_images, reporter, hedge)
+    elif provider == "Hugging Face":
+        return generate_huggingface_images(cfg, params, n_images, reporter, hedge)
+    else:
+        return generate_openai_compatible_images(client, cfg, params, n_images, reporter)
+
+class RaceReporter(BatchReporter):
+    """競速參賽者的事件接收者：只轉發領先者的進度，勝出後其餘參賽者停止發出請求"""
+    
+    def __init__(self, parent: BatchReporter, shared: Dict):
+        self.parent = parent
+        self.owner = parent.owner
+        self.shared = shared
+        self.images: List[Tuple[int, str]] = []
+        self.failures: List[Tuple[int, str]] = []
+    
+    def report_progress(self, completed: int, total: int, fraction: float, downloaded_bytes: int):
+        with self.shared["lock"]:
+            if fraction < self.shared["best"]:
+                return
+            self.shared["best"] = fraction
+        self.parent.report_progress(completed, total, fraction, downloaded_bytes)
+    
+    def report_image(self, index: int, blob_id: str):
+        self.images.append((index, blob_id))
+    
+    def report_failure(self, index: int, message: str):
+        self.failures.append((index, message))
+    
+    def cancelled(self) -> bool:
+        return self.shared["finished"].is_set() or self.parent.cancelled()
+
+def generate_race(entries: List[Tuple], params: Dict, n_images: int,
+                  reporter: BatchReporter, hedge: bool = False) -> Tuple[bool, any]:
+    """同時向多個等效的 (存檔, 模型) 發出請求，採用首個完整的結果，都不完整時採用張數最多者"""
+    shared = {"lock": threading.Lock(), "best": 0.0, "finished": threading.Event()}
+    # 每個參賽者一個執行緒；不使用對沖執行緒池，避免參賽者佔滿執行緒後等不到自己的對沖請求
+    executor = ThreadPoolExecutor(max_workers=len(entries), thread_name_prefix="race")
+    futures = {}
+    
+    for name, cfg, model, client in entries:
+        race_reporter = RaceReporter(reporter, shared)
+        future = executor.submit(
+            dispatch_generation, client, cfg, {**params, "model": model}, n_images, race_reporter, hedge
+        )
+        futures[future] = (name, cfg, race_reporter)
+    executor.shutdown(wait=False)
+    
+    errors = []
+    best = None  # 目前張數最多的部分結果：(存檔名, 結果, 參賽者)
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            name, cfg, race_reporter = futures[future]
+            try:
+                success, result = future.result()
+            except Exception as e:
+                success, result = False, str(e)[:200]
+            
+            if not success:
+                errors.append(f"{name or cfg.get('provider')}: {result}")
+                continue
+            
+            # 只返回部分圖片時先保留，等其餘參賽者可能返回的完整批次
+            if len(result.data) < n_images and pending and not reporter.cancelled():
+                if best is None or len(result.data) > len(best[1].data):
+                    best = (name, result, race_reporter)
+                continue
+            if best is not None and len(result.data) <= len(best[1].data):
+                continue
+            best = (name, result, race_reporter)
+            if len(result.data) >= n_images:
+                break
+        if best is not None and len(best[1].data) >= n_images:
+            break
+    
+    if best is None:
+        return False, "；".join(errors)
+    
+    # 已在進行中的落後請求無法中斷，其結果直接丟棄；勝出者的事件按原序號轉發
+    shared["finished"].set()
+    name, result, race_reporter = best
+    _, served_cfg, served_model, _ = next(entry for entry in entries if entry[0] == name)
+    for img in result.data:
+        img.served_cfg, img.served_model = served_cfg, served_model
+    for index, message in race_reporter.failures:
+        reporter.report_failure(index, message)
+    for index, blob_id in race_reporter.images:
+        reporter.report_image(index, blob_id)
+    result.race_winner = name
+    return True, result
+
+class RouteReporter(BatchReporter):
+    """路由子批次的事件接收者：把子批次的序號和進度換算到整個批次"""
+    
+    def __init__(self, parent: BatchReporter, name: str, index_offset: int, produced: int, total: int):
+        self.parent = parent
+        self.name = name
+        self.owner = parent.owner
+        self.index_offset = index_offset
+        self.produced = produced
+        self.total = total
+    
+    def report_progress(self, completed: int, total: int, fraction: float, downloaded_bytes: int):
+        self.parent.report_progress(
+            self.produced + completed, self.total,
+            min(1.0, (self.produced + fraction * total) / self.total), downloaded_bytes
+        )
+    
+    def report_image(self, index: int, blob_id: str):
+        self.parent.report_image(self.index_offset + index, blob_id)
+    
+    def report_failure(self, index: int, message: str):
+        self.parent.report_failure(self.index_offset + index, f"{self.name}: {message}")
+    
+    def cancelled(self) -> bool:
+        return self.parent.cancelled()
+
+def generate_routed(entries: List[Tuple], params: Dict, n_images: int,
+                    reporter: BatchReporter, hedge: bool = False) -> Tuple[bool, any]:
+    """把批次發往評分最高的存檔，未完成的圖片依次故障轉移到下一個存檔"""
+    stats = get_route_stats()
+    images = []
+    served_by = []
+    errors = []
+    attempted = 0
+    
+    for (name, cfg, model, client), _ in rank_routes(entries):
+        remaining = n_images - len(images)
+        if remaining <= 0 or reporter.cancelled():
+            break
+        
+        # 子批次使用不重疊的序號，避免故障轉移後的圖片覆蓋先前的結果
+        sub_reporter = RouteReporter(reporter, name, attempted, len(images), n_images)
+        attempted += remaining
+        try:
+            success, result = dispatch_generation(
+                client, cfg, {**params, "model": model, "n": remaining}, remaining, sub_reporter, hedge
+            )
+        except Exception as e:
+            success, result = False, str(e)[:200]
+        
+        produced = result.data if success else []
+        stats.record(cfg, model, remaining, len(produced))
+        if not success:
+            errors.append(f"{name}: {result}")
+            continue
+        
+        for img in produced:
+            img.served_cfg, img.served_model = cfg, model
+        images.extend(produced)
+        served_by.append(name)
+    
+    if not images:
+        return False, "；".join(errors) or "沒有可用的存檔"
+    return True, type('Response', (object,), {'data': images, 'served_by': served_by})
+
+def choose_seeds(params: Dict, n_images: int) -> List[int]:
+    """決定批次內每張圖片的種子：指定種子時逐張遞增，否則隨機"""
+    if params.get("seed") is not None:
+        return [int(params["seed"]) + i for i in range(n_images)]
+    return [random.randint(0, 2**32 - 1) for _ in range(n_images)]
+
+def generate_pollinations_images(cfg: Dict, params: Dict, n_images: int,
+                                 reporter: Optional[BatchReporter] = None, hedge: bool = False) -> Tuple[bool, any]:
+    """Pollinations.ai 圖像生成"""
+    seeds = choose_seeds(params, n_images)
+    
+    def request_image(i: int, ctx: RequestContext) -> str:
+        return request_pollinations_image(cfg, {**params, "seed": seeds[i]}, ctx)
+    
+    generated_images = [
+        type('Image', (object,), {
+            'blob_id': blob_id,
+            'seed': seeds[i],
+            'params': resolve_pollinations_params({**params, "seed": seeds[i]}),
+        })
+        for i, blob_id in run_concurrent_batch(
+            cfg, n_images, request_image, reporter,
+            flight_key_fn=lambda i: build_flight_key(cfg, {**params, "seed": seeds[i]}, i),
+            model=params.get("model"),
+            hedge=hedge
+        )
+    ]
+    
+    if generated_images:
+        response_obj = type('Response', (object,), {'data': generated_images})
+        return True, response_obj
+    else:
+        return False, "所有圖片生成均失敗"
+
+def resolve_pollinations_params(current_params: Dict) -> Dict:
+    """計算實際發送給 Pollinations.ai 的提示詞和查詢參數"""
+    # 構建提示詞
+    prompt = current_params.get("prompt", "")
+    if neg_prompt := current_params.get("negative_prompt"):
+        prompt += f" --no {neg_prompt}"
+    
+    # 解析尺寸
+    width, height = str(current_params.get("size", "1024x1024")).split('x')
+    
+    # API參數
+    api_params = {"prompt": prompt}
+    for key, value in {
+        "model": current_params.get("model"),
+        "width": width,
+        "height": height,
+        "seed": current_params.get("seed"),
+        "nologo": current_params.get("nologo"),
+        "private": current_params.get("private"),
+        "enhance": current_params.get("enhance"),
+        "safe": current_params.get("safe")
+    }.items():
+        if value is not None:
+            api_params[key] = value
+    return api_params
+
+def request_pollinations_image(cfg: Dict, current_params: Dict, ctx: Optional[RequestContext] = None) -> str:
+    """向 Pollinations.ai 請求單張圖片，返回圖片文件 ID（可在工作執行緒中調用）"""
+    api_params = resolve_pollinations_params(current_params)
+    prompt = api_params.pop("prompt")
+    
+    # 認證頭
+    headers = {}
+    auth_mode = cfg.get('pollinations_auth_mode', '免費')
+    
+    if auth_mode == '令牌' and cfg.get('pollinations_token'):
+        headers['Authorization'] = f"Bearer {cfg['pollinations_token']}"
+    elif auth_mode == '域名' and cfg.get('pollinations_referrer'):
+        headers['Referer'] = cfg['pollinations_referrer']
+    
+    # 發送請求
+    url = f"{cfg['base_url']}/prompt/{quote(prompt)}?{urlencode(api_params)}"
+    model = current_params.get("model")
+    return fetch_image(
+        get_http_transport(cfg['base_url'], cfg), "GET", url,
+        get_latency_tracker(cfg.get('provider'), model),
+        resolve_timeouts(cfg, model, ctx.deadline if ctx else None),
+        ctx, headers=headers
+    )
+
+def generate_huggingface_images(cfg: Dict, params: Dict, n_images: int,
+                                reporter: Optional[BatchReporter] = None, hedge: bool = False) -> Tuple[bool, any]:
+    """Hugging Face 圖像生成"""
+    seeds = choose_seeds(params, n_images)
+    
+    def request_image(i: int, ctx: RequestContext) -> str:
+        return request_huggingface_image(cfg, {**params, "seed": seeds[i]}, ctx)
+    
+    generated_images = [
+        type('Image', (object,), {
+            'blob_id': blob_id,
+            'seed': seeds[i],
+            'params': resolve_huggingface_payload({**params, "seed": seeds[i]}),
+        })
+        for i, blob_id in run_concurrent_batch(
+            cfg, n_images, request_image, reporter,
+            flight_key_fn=lambda i: build_flight_key(cfg, {**params, "seed": seeds[i]}, i),
+            model=params.get("model"),
+            hedge=hedge
+        )
+    ]
+    
+    if generated_images:
+        response_obj = type('Response', (object,), {'data': generated_images})
+        return True, response_obj
+    else:
+        return False, "所有圖片生成均失敗"
+
+def request_huggingface_image(cfg: Dict, params: Dict, ctx: Optional[RequestContext] = None) -> str:
+    """向 Hugging Face 請求單張圖片，返回圖片文件 ID（可在工作執行緒中調用）"""
+    headers = {"Authorization": f"Bearer {cfg['api_key']}"}
+    model = params.get("model")
+    payload = resolve_huggingface_payload(params)
+    
+    warmup = get_model_warmup()
+    warmup.mark_used(cfg, model)
+    # 已知模型加載中時讓服務端保持連接直到加載完成，而不是再次返回 503
+    loading_wait = warmup.loading_wait(cfg, model)
+    if loading_wait is not None:
+        payload["options"] = {"wait_for_model": True}
+        headers["x-wait-for-model"] = "true"
+    
+    url = f"{cfg['base_url']}/models/{model}"
+    try:
+        blob_id = fetch_image(
+            get_http_transport(cfg['base_url'], cfg), "POST", url,
+            get_latency_tracker(cfg.get('provider'), model),
+            resolve_timeouts(cfg, model, ctx.deadline if ctx else None, loading_wait or 0.0),
+            ctx, record_latency=loading_wait is None, headers=headers, json=payload
+        )
+    except ModelLoadingError as e:
+        warmup.mark_loading(cfg, model, e.estimated_time)
+        raise
+    warmup.mark_ready(cfg, model)
+    return blob_id
+
+def resolve_huggingface_payload(params: Dict) -> Dict:
+    """構建發送給 Hugging Face 的請求體"""
+    prompt = params.get("prompt", "")
+    
+    # HF API payload
+    payload = {
+        "inputs": prompt,
+        "parameters": {
+            "negative_prompt": params.get("negative_prompt", ""),
+            "num_inference_steps": 25,
+            "guidance_scale": 7.5,
+            "width": int(str(params.get("size", "512x512")).split('x')[0]),
+            "height": int(str(params.get("size", "512x512")).split('x')[1]),
+        }
+    }
+    
+    if params.get("seed") is not None:
+        payload["parameters"]["seed"] = int(params["seed"])
+    return payload
+
+@st.cache_resource
+def get_max_images_registry() -> Dict:
+    """獲取從響應中學到的各 (存檔, 模型) 單次請求張數上限"""
+    return {"lock": threading.Lock(), "limits": {}}
+
+def get_max_images_per_call(cfg: Dict, model: str) -> int:
+    """單次請求的張數上限：存檔配置 > 已學到的上限 > 已知模型 > 默認值"""
+    if cfg.get('max_images_per_call'):
+        return max(1, int(cfg['max_images_per_call']))
+    
+    registry = get_max_images_registry()
+    with registry["lock"]:
+        learned = registry["limits"].get((endpoint_key(cfg), model))
+    if learned is not None:
+        return learned
+    
+    model_id = str(model or "").lower().split('/')[-1]
+    return next((limit for prefix, limit in OPENAI_MAX_IMAGES_PER_CALL.items() if model_id.startswith(prefix)),
+                OPENAI_DEFAULT_MAX_IMAGES)
+
+def record_max_images_per_call(cfg: Dict, model: str, limit: int):
+    """記錄學到的單次張數上限（只會縮小）"""
+    registry = get_max_images_registry()
+    key = (endpoint_key(cfg), model)
+    with registry["lock"]:
+        registry["limits"][key] = max(1, min(limit, registry["limits"].get(key, limit)))
+
+def parse_max_images_error(error: Exception) -> Optional[int]:
+    """識別「n 超出模型上限」的 400 錯誤並返回上限（無法解析數值時為 1），其他錯誤返回 None"""
+    if not isinstance(error, APIStatusError) or error.status_code != 400:
+        return None
+    message = str(error)
+    if getattr(error, "param", None) != "n" and not re.search(r"\bn\b'?\s*(:|=|<=|must|should|cannot|is|exceed)", message):
+        return None
+    match = re.search(r"(?:<=|at most|less than or equal to|maximum of|must be|n=)\s*(\d+)", message)
+    return max(1, int(match.group(1))) if match else 1
+
+def plan_image_chunks(n_images: int, max_per_call: int, parallel: int) -> List[int]:
+    """把批次拆分為各子請求的張數：不超過單次上限，並盡量攤滿併發窗口"""
+    calls = max(math.ceil(n_images / max_per_call), min(n_images, max(1, parallel)))
+    base, extra = divmod(n_images, calls)
+    return [base + (1 if i < extra else 0) for i in range(calls)]
+
+def build_openai_params(params: Dict, n_images: int) -> Dict:
+    """構建 images.generate 的參數，非標準參數經 extra_body 傳遞"""
+    sdk_params = {
+        "model": params.get("model"),
+        "prompt": params.get("prompt"),
+        "size": str(params.get("size")),
+        "n": n_images,
+        "response_format": "b64_json"
+    }
+    
+    # 負向提示詞不是 SDK 的參數，支持的兼容接口從請求體讀取
+    if params.get("negative_prompt"):
+        sdk_params["extra_body"] = {"negative_prompt": params.get("negative_prompt")}
+    
+    # 過濾空值
+    return {k: v for k, v in sdk_params.items() if v is not None and v != ""}
+
+def generate_openai_compatible_images(client, cfg: Dict, params: Dict, n_images: int,
+                                      reporter: Optional[BatchReporter] = None) -> Tuple[bool, any]:
+    """OpenAI兼容API圖像生成：按模型的單次張數上限拆分為併發子請求，再合併結果"""
+    reporter = reporter or BatchReporter()
+    model = params.get("model")
+    provider = cfg.get('provider')
+    tracker = get_latency_tracker(provider, model)
+    limiter = get_rate_limiter(cfg)
+    breaker = get_circuit_breaker(cfg, model)
+    concurrency = get_concurrency_limiter(cfg)
+    scheduler = get_fair_scheduler()
+    flights = get_single_flight()
+    
+    parallel = int(concurrency.window)
+    
+    def split(offset: int, count: int, limit: int) -> List[Tuple[int, int]]:
+        sizes = plan_image_chunks(count, limit, parallel)
+        return [(offset + sum(sizes[:i]), size) for i, size in enumerate(sizes)]
+    
+    queue = split(0, n_images, get_max_images_per_call(cfg, model))
+    budget = tracker.batch_budget(len(queue), parallel, BATCH_DEADLINE_SECONDS)
+    if limiter is not None:
+        budget = min(BATCH_DEADLINE_SECONDS, budget + limiter.expected_delay(len(queue)))
+    deadline = time.monotonic() + budget
+    
+    def timed_generate(sdk_params: Dict):
+        # SDK 調用發出後無法中斷，只在發出前和等待名額時檢查取消
+        if reporter.cancelled():
+            raise RequestCancelled()
+        if limiter is not None:
+            limiter.acquire(deadline, reporter.cancelled)
+        timeouts = resolve_timeouts(cfg, model, deadline)
+        started = time.monotonic()
+        try:
+            result = concurrency.run(lambda: scheduler.run(
+                reporter.owner, lambda: client.images.generate(**sdk_params, timeout=timeouts["read"]),
+                sdk_params["n"], deadline, reporter.cancelled
+            ), deadline, reporter.cancelled)
+        except APITimeoutError:
+            tracker.record_timeout(time.monotonic() - started)
+            raise
+        elapsed = time.monotonic() - started
+        tracker.record(elapsed, elapsed)
+        return result
+    
+    def request_chunk(offset: int, count: int):
+        # 合併跨會話的相同子請求，並按策略重試暫時性錯誤
+        sdk_params = build_openai_params(params, count)
+        flight_key = f"{build_flight_key(cfg, sdk_params)}:{offset}"
+        return flights.do(flight_key, lambda: call_with_retry(
+            lambda: timed_generate(sdk_params), provider, deadline, breaker, reporter.cancelled
+        ))
+    
+    # API 只能返回 base64，在此解碼一次後以文件形式傳遞
+    blob_store = get_blob_store()
+    images = {}
+    errors = []
+    finished = 0
+    
+    # 子請求在各自的執行緒中排隊，只在發出請求時佔用排程名額
+    executor = ThreadPoolExecutor(max_workers=max(1, n_images), thread_name_prefix="batch")
+    while queue:
+        futures = {executor.submit(request_chunk, offset, count): (offset, count) for offset, count in queue}
+        queue = []
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset, count = futures[future]
+                try:
+                    data = future.result().data[:count]
+                except Exception as e:
+                    limit = parse_max_images_error(e)
+                    if limit is not None and limit < count:
+                        # 超出模型的單次上限：記住上限並把這部分拆小重發
+                        record_max_images_per_call(cfg, model, limit)
+                        queue.extend(split(offset, count, limit))
+                        continue
+                    finished += count
+                    errors.append(str(e)[:200])
+                    for i in range(offset, offset + count):
+                        reporter.report_failure(i, f"第 {i + 1} 張圖片生成失敗: {str(e)[:100]}")
+                    continue
+                
+                for i, img in enumerate(data):
+                    blob_id = blob_store.put_bytes(base64.b64decode(img.b64_json))
+                    # 該接口不支持種子，只記錄實際發送的參數
+                    images[offset + i] = type('Image', (object,), {
+                        'blob_id': blob_id, 'seed': None, 'params': build_openai_params(params, 1)
+                    })
+                    reporter.report_image(offset + i, blob_id)
+                finished += len(data)
+                if 0 < len(data) < count:
+                    # 接口默默少返回時同樣按實際張數學習上限，補發缺少的部分
+                    record_max_images_per_call(cfg, model, len(data))
+                    queue.extend(split(offset + len(data), count - len(data), len(data)))
+                elif not data:
+                    finished += count
+                    for i in range(offset, offset + count):
+                        reporter.report_failure(i, f"第 {i + 1} 張圖片沒有返回")
+            reporter.report_progress(finished, n_images, finished / n_images, 0)
+    executor.shutdown(wait=False)
+    
+    if images:
+        return True, type('Response', (object,), {'data': [images[i] for i in sorted(images)]})
+    return False, errors[0] if errors else "所有圖片生成均失敗"
+
+# === 後台生成任務 ===
+
+class GenerationJob(BatchReporter):
+    """一次生成提交：在後台執行緒中運行，界面只讀取其狀態快照"""
+    
+    def __init__(self, owner: str, client, cfg: Dict, params: Dict, use_cache: bool, metadata: Dict,
+                 hedge: bool = False, race: Optional[List[Tuple]] = None,
+                 route: Optional[List[Tuple]] = None):
+        self.id = str(uuid.uuid4())
+        self.owner = owner
+        self.client = client
+        self.cfg = dict(cfg)
+        self.params = dict(params)
+        self.use_cache = use_cache
+        self.hedge = hedge
+        self.race = race
+        self.route = route
+        self.race_winner = None
+        self.served_by = []
+        self.metadata = metadata
+        self.state = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.completed = 0
+        self.total = params.get("n", 1)
+        self.fraction = 0.0
+        self.downloaded_bytes = 0
+        self.images: Dict[int, str] = {}
+        self.failures: Dict[int, str] = {}
+        self.warnings: List[str] = []
+        self.result: List[str] = []
+        self.images_meta: List[Dict] = []
+        self.cached = False
+        self.error = None
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
+    
+    def cancel(self):
+        """請求取消：尚未發出的請求不再發出，進行中的請求盡快中止"""
+        self._cancel_event.set()
+    
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+    
+    def report_progress(self, completed: int, total: int, fraction: float, downloaded_bytes: int):
+        with self._lock:
+            self.completed, self.total = completed, total
+            self.fraction, self.downloaded_bytes = fraction, downloaded_bytes
+    
+    def report_image(self, index: int, blob_id: str):
+        with self._lock:
+            self.images[index] = blob_id
+    
+    def report_failure(self, index: int, message: str):
+        with self._lock:
+            self.warnings.append(message)
+            self.failures[index] = message
+    
+    def _slots(self) -> List[Dict]:
+        """按序號排列的每張圖片狀態（pending / done / failed），故障轉移得到的圖片補入最早未完成的位置"""
+        total = max(1, int(self.params.get("n", 1)))
+        slots = [{"state": "pending", "blob_id": None, "error": None} for _ in range(total)]
+        overflow = []
+        for index, blob_id in sorted(self.images.items()):
+            if index < total:
+                slots[index] = {"state": "done", "blob_id": blob_id, "error": None}
+            else:
+                overflow.append(blob_id)
+        for index, message in self.failures.items():
+            if index < total and slots[index]["state"] == "pending":
+                slots[index] = {"state": "failed", "blob_id": None, "error": message}
+        
+        finished = self.state in ("done", "failed")
+        for slot in slots:
+            if slot["state"] != "done" and overflow:
+                slot.update(state="done", blob_id=overflow.pop(0), error=None)
+            elif slot["state"] == "pending" and finished:
+                slot.update(state="failed", error=self.error or "沒有返回此圖片")
+        return slots
+    
+    def run(self):
+        """在任務執行緒中執行生成，任何異常都轉為失敗狀態"""
+        with self._lock:
+            self.state = "running"
+        try:
+            success, result = generate_images_with_retry(
+                self.client, self.cfg, self, use_cache=self.use_cache, hedge=self.hedge,
+                race=self.race, route=self.route, **self.params
+            )
+        except Exception as e:
+            success, result = False, str(e)[:200]
+        
+        with self._lock:
+            if success and hasattr(result, 'data') and result.data:
+                self.result = [img.blob_id for img in result.data]
+                self.images_meta = [
+                    {"seed": getattr(img, 'seed', None), "params": getattr(img, 'params', {})}
+                    for img in result.data
+                ]
+                self.cached = getattr(result, 'cached', False)
+                self.race_winner = getattr(result, 'race_winner', None)
+                self.served_by = getattr(result, 'served_by', [])
+                self.state = "done"
+            else:
+                self.error = result or "沒有返回任何圖像"
+                self.state = "failed"
+            self.finished = time.time()
+    
+    def snapshot(self) -> Dict:
+        """返回可在界面中安全讀取的狀態副本"""
+        with self._lock:
+            return {
+                "id": self.id,
+                "state": self.state,
+                "completed": self.completed,
+                "total": self.total,
+                "fraction": self.fraction,
+                "downloaded_bytes": self.downloaded_bytes,
+                "images": [self.images[i] for i in sorted(self.images)],
+                "slots": self._slots(),
+                "warnings": list(self.warnings),
+                "result": list(self.result),
+                "images_meta": list(self.images_meta),
+                "cancelled": self.cancelled(),
+                "cached": self.cached,
+                "race_winner": self.race_winner,
+                "served_by": list(self.served_by),
+                "error": self.error,
+                "metadata": self.metadata,
+                "elapsed": (self.finished or time.time()) - self.created,
+            }
+
+class SweepJob(BatchReporter):
+    """參數掃描：逐格生成單張圖片，按有限併發執行並逐格更新結果"""
     
-    st.session_state.generation_in_progress = True
+    def __init__(self, owner: str, client, cfg: Dict, cells: List[Dict], use_cache: bool):
+        self.id = str(uuid.uuid4())
+        self.owner = owner
+        self.client = client
+        self.cfg = dict(cfg)
+        self.use_cache = use_cache
+        self.state = "queued"
+        self.created = time.time()
+        self.finished = None
+        self.cells = [{**cell, "state": "queued", "blob_id": None, "error": None} for cell in cells]
+        self._cancel_event = threading.Event()
+        self._lock = threading.Lock()
     
-    try:
-        if provider == "Pollinations.ai":
-            return generate_pollinations_images(params, n_images)
-        elif provider == "Hugging Face":
-            return generate_huggingface_images(params, n_images)
-        else:
-            return generate_openai_compatible_images(client, params, n_images)
-    finally:
-        st.session_state.generation_in_progress = False
-        st.session_state.last_generation_time = datetime.datetime.now()
-
-def generate_pollinations_images(params: Dict, n_images: int) -> Tuple[bool, any]:
-    """Pollinations.ai 圖像生成"""
-    generated_images = []
-    cfg = get_active_config()
+    def cancel(self):
+        self._cancel_event.set()
     
-    # 創建進度條
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
     
-    for i in range(n_images):
+    def _update(self, index: int, **fields):
+        with self._lock:
+            self.cells[index].update(fields)
+    
+    def run_cell(self, index: int):
+        cell = self.cells[index]
+        if self.cancelled():
+            self._update(index, state="failed", error="已取消")
+            return
+        self._update(index, state="running")
         try:
-            status_text.text(f"正在生成第 {i+1}/{n_images} 張圖片...")
-            progress_bar.progress((i) / n_images)
-            
-            current_params = params.copy()
-            current_params["seed"] = random.randint(0, 2**32 - 1)
-            
-            # 構建提示詞
-            prompt = current_params.get("prompt", "")
-            if neg_prompt := current_params.get("negative_prompt"):
-                prompt += f" --no {neg_prompt}"
-            
-            # 解析尺寸
-            width, height = str(current_params.get("size", "1024x1024")).split('x')
-            
-            # API參數
-            api_params = {}
-            for key, value in {
-                "model": current_params.get("model"),
-                "width": width,
-                "height": height,
-                "seed": current_params.get("seed"),
-                "nologo": current_params.get("nologo"),
-                "private": current_params.get("private"),
-                "enhance": current_params.get("enhance"),
-                "safe": current_params.get("safe")
-            }.items():
-                if value is not None:
-                    api_params[key] = value
-            
-            # 認證頭
-            headers = {}
-            auth_mode = cfg.get('pollinations_auth_mode', '免費')
-            
-            if auth_mode == '令牌' and cfg.get('pollinations_token'):
-                headers['Authorization'] = f"Bearer {cfg['pollinations_token']}"
-            elif auth_mode == '域名' and cfg.get('pollinations_referrer'):
-                headers['Referer'] = cfg['pollinations_referrer']
-            
-            # 發送請求
-            url = f"{cfg['base_url']}/prompt/{quote(prompt)}?{urlencode(api_params)}"
-            response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
-            
-            if response.ok:
-                b64_json = base64.b64encode(response.content).decode()
-                image_obj = type('Image', (object,), {'b64_json': b64_json})
-                generated_images.append(image_obj)
-            else:
-                st.warning(f"第 {i+1} 張圖片生成失敗: HTTP {response.status_code}")
-                
+            success, result = generate_images_with_retry(
+                self.client, self.cfg, self, use_cache=self.use_cache,
+                route=cell.get("route"), **cell["params"]
+            )
         except Exception as e:
-            st.warning(f"第 {i+1} 張圖片生成錯誤: {str(e)[:100]}")
-            continue
+            success, result = False, str(e)[:200]
+        
+        if success and result.data:
+            img = result.data[0]
+            self._update(index, state="done", blob_id=img.blob_id,
+                         seed=getattr(img, 'seed', None), resolved=getattr(img, 'params', {}))
+        else:
+            self._update(index, state="failed", error=result or "沒有返回任何圖像")
     
-    # 清理UI
-    progress_bar.progress(1.0)
-    status_text.text(f"完成生成 {len(generated_images)}/{n_images} 張圖片")
-    time.sleep(1)
-    progress_bar.empty()
-    status_text.empty()
+    def run(self):
+        """在任務執行緒中執行整個掃描"""
+        with self._lock:
+            self.state = "running"
+        with ThreadPoolExecutor(max_workers=SWEEP_CONCURRENCY, thread_name_prefix="sweep") as executor:
+            list(executor.map(self.run_cell, range(len(self.cells))))
+        with self._lock:
+            self.state = "done"
+            self.finished = time.time()
     
-    if generated_images:
-        response_obj = type('Response', (object,), {'data': generated_images})
-        return True, response_obj
-    else:
-        return False, "所有圖片生成均失敗"
+    def snapshot(self) -> Dict:
+        """返回可在界面中安全讀取的狀態副本（不含路由客戶端）"""
+        with self._lock:
+            return {
+                "id": self.id,
+                "state": self.state,
+                "provider": self.cfg.get('provider'),
+                "cancelled": self.cancelled(),
+                "cells": [{k: v for k, v in cell.items() if k != "route"} for cell in self.cells],
+                "elapsed": (self.finished or time.time()) - self.created,
+            }
 
-def generate_huggingface_images(params: Dict, n_images: int) -> Tuple[bool, any]:
-    """Hugging Face 圖像生成"""
-    generated_images = []
-    cfg = get_active_config()
+def parse_seed_list(text: str) -> List[Optional[int]]:
+    """解析種子列表：逗號分隔，支持 a-b 範圍；留空表示隨機。格式無效或數量超過上限時拋出 ValueError"""
+    seeds = []
+    for part in re.split(r"[,，\s]+", text.strip()):
+        if not part:
+            continue
+        if re.fullmatch(r"\d+-\d+", part):
+            start, end = map(int, part.split("-"))
+        elif re.fullmatch(r"\d+", part):
+            start = end = int(part)
+        else:
+            raise ValueError(f"無法解析「{part}」")
+        if end > 2**32 - 1:
+            raise ValueError(f"種子不能大於 {2**32 - 1}")
+        if end < start:
+            raise ValueError(f"範圍「{part}」的起點大於終點")
+        # 先檢查數量再展開，避免過大的範圍耗盡內存
+        if len(seeds) + (end - start + 1) > SWEEP_MAX_CELLS:
+            raise ValueError(f"種子數量超過上限 {SWEEP_MAX_CELLS}")
+        seeds.extend(range(start, end + 1))
+    return seeds or [None]
+
+def expand_sweep(prompts: List[str], styles: List[str], sizes: List[str], models: List[str],
+                 seeds: List[Optional[int]], negative_prompt: str,
+                 limit: Optional[int] = None) -> Tuple[List[Dict], int]:
+    """展開參數的笛卡兒積並合併完全相同的請求，返回 (組合列表, 組合數)；組合數超過 limit 時不展開"""
+    # 只有提示詞和風格的組合可能得到相同的請求，其餘維度去重後相乘即為組合數
+    variants = {}  # 最終提示詞 -> 首個得到它的 (提示詞, 風格)
+    for prompt, style in itertools.product(prompts, styles):
+        variants.setdefault(build_final_prompt(prompt, style), (prompt, style))
+    sizes, models, seeds = (list(dict.fromkeys(values)) for values in (sizes, models, seeds))
+    total = len(variants) * len(sizes) * len(models) * len(seeds)
+    if limit is not None and total > limit:
+        return [], total
     
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    cells = []
+    for (final_prompt, (prompt, style)), size, model, seed in itertools.product(variants.items(), sizes, models, seeds):
+        params = {
+            "model": model,
+            "prompt": final_prompt,
+            "negative_prompt": negative_prompt,
+            "size": size,
+            "n": 1,
+        }
+        if seed is not None:
+            params["seed"] = seed
+        cells.append({
+            "params": params,
+            "label": {"prompt": prompt, "style": style, "size": size, "model": model, "seed": seed},
+        })
+    return cells, total
+
+class JobManager:
+    """進程級任務隊列：提交後立即返回任務 ID，由獨立執行緒池執行，不受腳本重跑影響"""
     
-    for i in range(n_images):
-        try:
-            status_text.text(f"正在通過HF生成第 {i+1}/{n_images} 張圖片...")
-            progress_bar.progress(i / n_images)
-            
-            headers = {"Authorization": f"Bearer {cfg['api_key']}"}
-            model = params.get("model")
-            prompt = params.get("prompt", "")
-            
-            # HF API payload
-            payload = {
-                "inputs": prompt,
-                "parameters": {
-                    "negative_prompt": params.get("negative_prompt", ""),
-                    "num_inference_steps": 25,
-                    "guidance_scale": 7.5,
-                    "width": int(str(params.get("size", "512x512")).split('x')[0]),
-                    "height": int(str(params.get("size", "512x512")).split('x')[1]),
-                }
-            }
-            
-            url = f"{cfg['base_url']}/models/{model}"
-            response = requests.post(url, headers=headers, json=payload, timeout=REQUEST_TIMEOUT)
-            
-            if response.ok:
-                b64_json = base64.b64encode(response.content).decode()
-                image_obj = type('Image', (object,), {'b64_json': b64_json})
-                generated_images.append(image_obj)
-            else:
-                st.warning(f"第 {i+1} 張圖片生成失敗: HTTP {response.status_code}")
-                
-        except Exception as e:
-            st.warning(f"第 {i+1} 張圖片生成錯誤: {str(e)[:100]}")
-            continue
+    def __init__(self, workers: int, retention: float):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="generation-job")
+        self.retention = retention
+        self.jobs: Dict[str, GenerationJob] = {}
+        self.sessions: Dict[str, str] = {}  # 任務 ID -> 提交任務的 Streamlit 會話 ID
+        self._disconnected: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._watch_sessions, name="job-session-watch", daemon=True).start()
     
-    progress_bar.progress(1.0)
-    status_text.text(f"完成生成 {len(generated_images)}/{n_images} 張圖片")
-    time.sleep(1)
-    progress_bar.empty()
-    status_text.empty()
+    def submit(self, job: GenerationJob) -> str:
+        ctx = get_script_run_ctx()
+        with self._lock:
+            self._prune()
+            self.jobs[job.id] = job
+            if ctx is not None:
+                self.sessions[job.id] = ctx.session_id
+        self.executor.submit(job.run)
+        return job.id
     
-    if generated_images:
-        response_obj = type('Response', (object,), {'data': generated_images})
-        return True, response_obj
-    else:
-        return False, "所有圖片生成均失敗"
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        with self._lock:
+            return self.jobs.get(job_id)
+    
+    def forget(self, job_id: str):
+        with self._lock:
+            self.jobs.pop(job_id, None)
+            self.sessions.pop(job_id, None)
+    
+    def active_count(self, owner: str) -> int:
+        with self._lock:
+            return sum(1 for job in self.jobs.values()
+                       if job.owner == owner and job.state in ("queued", "running"))
+    
+    def _prune(self):
+        """丟棄長時間無人領取的已結束任務（例如會話已關閉）"""
+        cutoff = time.time() - self.retention
+        for job_id, job in list(self.jobs.items()):
+            if job.finished is not None and job.finished < cutoff:
+                self.jobs.pop(job_id, None)
+                self.sessions.pop(job_id, None)
+    
+    def _watch_sessions(self):
+        """瀏覽器斷開超過寬限期後取消該會話未完成的任務，不再為無人查看的結果佔用出站連接"""
+        while True:
+            time.sleep(DISCONNECT_CHECK_INTERVAL)
+            if not Runtime.exists():
+                continue
+            runtime = Runtime.instance()
+            now = time.monotonic()
+            with self._lock:
+                running = [(job, self.sessions[job.id]) for job in self.jobs.values()
+                           if job.state in ("queued", "running") and job.id in self.sessions]
+                self._disconnected = {session_id: since for session_id, since in self._disconnected.items()
+                                      if session_id in self.sessions.values()}
+            
+            for job, session_id in running:
+                if runtime.is_active_session(session_id):
+                    self._disconnected.pop(session_id, None)
+                    continue
+                since = self._disconnected.setdefault(session_id, now)
+                if now - since >= DISCONNECT_GRACE_SECONDS and not job.cancelled():
+                    job.cancel()
 
-def generate_openai_compatible_images(client, params: Dict, n_images: int) -> Tuple[bool, any]:
-    """OpenAI兼容API圖像生成"""
-    try:
-        sdk_params = {
-            "model": params.get("model"),
-            "prompt": params.get("prompt"),
-            "size": str(params.get("size")),
-            "n": n_images,
-            "response_format": "b64_json"
-        }
-        
-        # 添加負向提示詞支持（如果API支持）
-        if params.get("negative_prompt"):
-            sdk_params["negative_prompt"] = params.get("negative_prompt")
-        
-        # 過濾空值
-        sdk_params = {k: v for k, v in sdk_params.items() 
-                     if v is not None and v != ""}
-        
-        return True, client.images.generate(**sdk_params)
-        
-    except Exception as e:
-        return False, str(e)[:200]
+@st.cache_resource
+def get_job_manager() -> JobManager:
+    """獲取進程級共享的後台任務管理器"""
+    return JobManager(JOB_WORKER_COUNT, JOB_RETENTION_SECONDS)
+
+def get_session_id() -> str:
+    """獲取當前瀏覽器會話的穩定 ID，用於標記任務歸屬"""
+    if 'client_session_id' not in st.session_state:
+        st.session_state.client_session_id = str(uuid.uuid4())
+    return st.session_state.client_session_id
 
 # === 歷史和收藏管理 ===
 
 def add_to_history(prompt: str, negative_prompt: str, model: str, 
                   images: List[str], metadata: Dict):
-    """添加到歷史記錄"""
+    """添加到歷史記錄（images 為圖片文件 ID 列表）"""
     history = st.session_state.generation_history
     
     new_entry = {
@@ -683,26 +3553,44 @@ def add_to_history(prompt: str, negative_prompt: str, model: str,
     history.insert(0, new_entry)
     st.session_state.generation_history = history[:MAX_HISTORY_ITEMS]
 
-def display_image_with_actions(b64_json: str, image_id: str, history_item: Dict):
+def pin_favorite_images():
+    """為本會話收藏的圖片續期，避免共享存儲按容量淘汰時刪除收藏"""
+    blob_ids = [fav['blob_id'] for fav in st.session_state.favorite_images if fav.get('blob_id')]
+    if blob_ids:
+        get_blob_store().pin(blob_ids)
+
+def display_image_with_actions(blob_id: str, image_id: str, history_item: Dict):
     """顯示圖片及操作按鈕"""
     try:
-        img_data = base64.b64decode(b64_json)
-        img = Image.open(BytesIO(img_data))
+        img_data = get_blob_store().read(blob_id)
+        if img_data is None:
+            st.warning("⚠️ 圖片文件已過期，請重新生成")
+            return
         
         # 顯示圖片
-        st.image(img, use_container_width=True)
+        st.image(img_data, use_container_width=True)
+        
+        # 該圖片的種子和實際請求參數
+        metadata = history_item.get('metadata', {})
+        images = history_item.get('images', [])
+        images_meta = metadata.get('images_meta', [])
+        index = images.index(blob_id) if blob_id in images else -1
+        image_meta = images_meta[index] if 0 <= index < len(images_meta) else {}
         
         # 圖片信息
         if st.session_state.get('advanced_mode', False):
+            img = Image.open(BytesIO(img_data))
             with st.expander("🔍 圖片信息"):
                 st.json({
                     "尺寸": f"{img.size[0]}x{img.size[1]}",
                     "模式": img.mode,
-                    "文件大小": f"{len(img_data)} bytes"
+                    "文件大小": f"{len(img_data)} bytes",
+                    "種子": image_meta.get('seed'),
+                    "請求參數": image_meta.get('params', {})
                 })
         
         # 操作按鈕
-        col1, col2, col3 = st.columns(3)
+        col1, col2, col3, col4 = st.columns(4)
         
         with col1:
             st.download_button(
@@ -730,9 +3618,10 @@ def display_image_with_actions(b64_json: str, image_id: str, history_item: Dict)
                     ]
                 else:
                     if len(st.session_state.favorite_images) < MAX_FAVORITE_ITEMS:
+                        get_blob_store().pin([blob_id])
                         st.session_state.favorite_images.append({
                             "id": image_id,
-                            "image_b64": b64_json,
+                            "blob_id": blob_id,
                             "timestamp": datetime.datetime.now(),
                             "history_item": history_item
                         })
@@ -753,10 +3642,48 @@ def display_image_with_actions(b64_json: str, image_id: str, history_item: Dict)
                     'vary_model': history_item['model']
                 })
                 rerun_app()
+        
+        with col4:
+            seed = image_meta.get('seed')
+            if st.button(
+                "🔁",
+                key=f"regen_{image_id}",
+                use_container_width=True,
+                disabled=seed is None or 'request_params' not in metadata,
+                help=f"使用相同種子 {seed} 精確重現" if seed is not None else "此圖片沒有記錄種子，無法精確重現"
+            ):
+                regenerate_exact(history_item, seed)
                 
     except Exception as e:
         st.error(f"圖像顯示錯誤: {str(e)[:100]}")
 
+def regenerate_exact(history_item: Dict, seed: int):
+    """以相同參數和種子提交單張生成任務，優先命中本地快取"""
+    metadata = history_item['metadata']
+    cfg = get_active_config()
+    if len(st.session_state.active_jobs) >= MAX_ACTIVE_JOBS_PER_SESSION:
+        st.warning(f"最多同時執行 {MAX_ACTIVE_JOBS_PER_SESSION} 個任務")
+        return
+    if metadata.get('provider') and cfg.get('provider') != metadata['provider']:
+        st.toast(f"⚠️ 原圖由 {metadata['provider']} 生成，當前存檔為 {cfg.get('provider')}，結果可能不同")
+    
+    params = {**metadata['request_params'], "n": 1, "seed": seed}
+    history = {k: v for k, v in metadata.items() if k not in ("images_meta", "race_winner", "served_by")}
+    job = GenerationJob(
+        get_session_id(), init_api_client(), cfg, params, True,
+        {
+            "prompt": history_item['prompt'],
+            "negative_prompt": history_item.get('negative_prompt', ''),
+            "model": history_item['model'],
+            "history": {**history, "n": 1, "request_params": params, "provider": cfg.get('provider'),
+                        "model_name": metadata.get('model_name', history_item['model'])}
+        }
+    )
+    get_job_manager().submit(job)
+    st.session_state.active_jobs = st.session_state.active_jobs + [job.id]
+    st.toast(f"🔁 已提交重現任務（種子 {seed}）")
+    rerun_app()
+
 # === API客戶端管理 ===
 
 def init_api_client():
@@ -765,7 +3692,7 @@ def init_api_client():
     if (cfg and cfg.get('api_key') and 
         cfg.get('provider') not in ["Pollinations.ai", "Hugging Face"]):
         try:
-            return OpenAI(api_key=cfg['api_key'], base_url=cfg['base_url'])
+            return get_openai_client(cfg['api_key'], cfg['base_url'])
         except Exception:
             return None
     return None
@@ -777,12 +3704,14 @@ def editor_provider_changed():
     provider = st.session_state.editor_provider_selectbox
     st.session_state.editor_base_url = API_PROVIDERS[provider]['base_url_default']
     st.session_state.editor_api_key = ""
+    st.session_state.editor_max_concurrency = DEFAULT_PROVIDER_CONCURRENCY.get(provider, 2)
 
 def load_profile_to_editor_state(profile_name: str):
     """加載配置到編輯器狀態"""
     config = st.session_state.api_profiles.get(profile_name, {})
     provider = config.get('provider', 'Pollinations.ai')
     
+    st.session_state.editor_profile_name = profile_name
     st.session_state.editor_provider_selectbox = provider
     st.session_state.editor_base_url = config.get(
         'base_url',
@@ -792,6 +3721,7 @@ def load_profile_to_editor_state(profile_name: str):
     st.session_state.editor_auth_mode = config.get('pollinations_auth_mode', '免費')
     st.session_state.editor_referrer = config.get('pollinations_referrer', '')
     st.session_state.editor_token = config.get('pollinations_token', '')
+    st.session_state.editor_max_concurrency = get_provider_concurrency(config)
     st.session_state.profile_being_edited = profile_name
 
 def show_api_settings():
@@ -808,12 +3738,16 @@ def show_api_settings():
                     if st.session_state.get('active_profile_name') in profile_names
                     else 0)
     
+    health = get_profile_health()
+    badges = {name: health_badge(health.status(cfg)) for name, cfg in st.session_state.api_profiles.items()}
     active_profile_name = st.selectbox(
         "活動存檔",
         profile_names,
         index=current_index,
-        help="選擇要使用的API配置"
+        format_func=lambda name: f"{badges[name]} {name}",
+        help="選擇要使用的API配置；狀態由後台定期檢查，切換存檔不會等待網絡請求"
     )
+    show_profile_health(st.session_state.api_profiles[active_profile_name])
     
     # 檢查是否需要重載
     if (st.session_state.get('active_profile_name') != active_profile_name or
@@ -822,7 +3756,6 @@ def show_api_settings():
         
         st.session_state.active_profile_name = active_profile_name
         load_profile_to_editor_state(active_profile_name)
-        st.session_state.discovered_models = {}
         rerun_app()
     
     # 配置管理按鈕
@@ -859,13 +3792,33 @@ def show_api_settings():
     if active_profile_name:
         show_profile_editor(active_profile_name)
 
+def health_badge(status: Dict) -> str:
+    """存檔健康狀態徽章"""
+    if status["checking"] and status["state"] == "unknown":
+        return "⏳"
+    return {"ok": "🟢", "degraded": "🟡", "failed": "🔴"}.get(status["state"], "⚪")
+
+def show_profile_health(cfg: Dict):
+    """顯示活動存檔最近一次後台檢查的結果，檢查進行中時輪詢直到完成"""
+    status = get_profile_health().status(cfg)
+    if status["checked_at"]:
+        age_minutes = int((time.time() - status["checked_at"]) // 60)
+        st.caption(f"{health_badge(status)} {status['message']} · {age_minutes} 分鐘前檢查")
+    
+    if status["checking"]:
+        def render_health_check():
+            if not get_profile_health().status(cfg)["checking"]:
+                rerun_app()
+            st.caption("⏳ 正在後台檢查存檔…")
+        
+        run_polling(render_health_check)
+
 def show_profile_editor(profile_name: str):
     """顯示配置編輯器"""
     with st.expander("📝 編輯當前活動存檔", expanded=True):
         # 基本信息
         st.text_input(
             "存檔名稱",
-            value=profile_name,
             key="editor_profile_name",
             help="為此API配置設置一個易識別的名稱"
         )
@@ -900,6 +3853,15 @@ def show_profile_editor(profile_name: str):
                 help="您的API密鑰或令牌"
             )
         
+        # 併發設置
+        st.number_input(
+            "⚡ 初始併發請求數",
+            min_value=1,
+            max_value=GENERATION_POOL_SIZE,
+            key='editor_max_concurrency',
+            help="批量生成的起始併發窗口，之後按成功及 429/503/超時反饋自動調整（跨所有會話共享）"
+        )
+        
         # 保存按鈕
         if st.button("💾 保存/更新存檔", type="primary"):
             save_profile_config(profile_name, provider)
@@ -933,7 +3895,11 @@ def save_profile_config(profile_name: str, provider: str):
     """保存配置"""
     new_config = {
         'provider': provider,
-        'base_url': st.session_state.editor_base_url
+        'base_url': st.session_state.editor_base_url,
+        'max_concurrency': int(st.session_state.get(
+            'editor_max_concurrency',
+            DEFAULT_PROVIDER_CONCURRENCY.get(provider, 2)
+        ))
     }
     
     if provider == "Pollinations.ai":
@@ -951,13 +3917,15 @@ def save_profile_config(profile_name: str, provider: str):
             'pollinations_token': ''
         })
     
-    # 驗證配置
-    is_valid, msg = validate_api_key(
-        new_config['api_key'],
-        new_config['base_url'],
-        new_config['provider']
-    )
-    new_config['validated'] = is_valid
+    # 在後台重新驗證，相同憑證已有確定結果時先沿用，否則沿用原存檔的驗證狀態
+    health = get_profile_health()
+    health.check(new_config, force=True)
+    validated = health.status(new_config)["validated"]
+    if validated is None:
+        old_config = st.session_state.api_profiles.get(profile_name, {})
+        validated = bool(old_config.get('validated')) and \
+            discovery_key(old_config) == discovery_key(new_config)
+    new_config['validated'] = validated
     
     # 保存配置
     new_name = st.session_state.editor_profile_name
@@ -967,13 +3935,7 @@ def save_profile_config(profile_name: str, provider: str):
     st.session_state.api_profiles[new_name] = new_config
     st.session_state.active_profile_name = new_name
     
-    # 顯示結果
-    if is_valid:
-        st.success(f"存檔 '{new_name}' 已保存並驗證成功！")
-    else:
-        st.warning(f"存檔 '{new_name}' 已保存，但驗證失敗: {msg}")
-    
-    time.sleep(1.5)
+    st.toast(f"💾 存檔 '{new_name}' 已保存，正在後台驗證")
     rerun_app()
 
 def show_model_selector(all_models: Dict[str, Dict]) -> Optional[str]:
@@ -1000,6 +3962,10 @@ def show_model_selector(all_models: Dict[str, Dict]) -> Optional[str]:
         
         if model_info.get('description'):
             st.caption(f"📝 {model_info['description']}")
+        
+        cfg = get_active_config()
+        if cfg.get('provider') == "Hugging Face" and cfg.get('api_key'):
+            show_model_warmth(cfg, current_selection)
     
     st.markdown("---")
     
@@ -1037,6 +4003,26 @@ def show_model_selector(all_models: Dict[str, Dict]) -> Optional[str]:
     
     return current_selection
 
+def show_model_warmth(cfg: Dict, model: str):
+    """顯示 Hugging Face 模型的加載狀態，並可在選中時後台預熱"""
+    warmup = get_model_warmup()
+    prewarm = st.toggle(
+        "🔥 選中時預熱模型",
+        value=True,
+        key="hf_prewarm",
+        help="選中模型後在後台發送一個極小的請求觸發加載，避免第一張圖片等待冷啟動"
+    )
+    if prewarm:
+        warmup.prewarm(cfg, model)
+    
+    state = warmup.state(cfg, model)
+    if state == "loading":
+        st.caption(f"🔥 模型加載中，預計還需 {warmup.remaining_load(cfg, model):.0f} 秒")
+    elif state == "warm":
+        st.caption("✅ 模型已預熱")
+    else:
+        st.caption("❄️ 模型狀態未知，首次請求可能需要等待冷啟動")
+
 def show_model_grid(models: Dict[str, Dict], category_name: str):
     """顯示模型網格"""
     with st.expander(f"📁 {category_name} ({len(models)} 個模型)", expanded=True):
@@ -1138,13 +4124,27 @@ def show_generation_interface():
             "🔧 高級選項",
             value=st.session_state.get('advanced_mode', False)
         )
+        
+        use_cache = st.toggle(
+            "♻️ 使用結果快取",
+            value=True,
+            help="相同請求直接返回已快取的圖片，關閉則強制重新生成"
+        )
+        
+        hedge = st.toggle(
+            "⚡ 對沖慢請求",
+            value=False,
+            help="單張圖片超過該模型 p90 延遲仍未返回時，發送一次相同種子的備份請求並採用先完成者（額外請求受預算限制）"
+        )
     
     return {
         'prompt': prompt_val,
         'negative_prompt': negative_prompt_val,
         'style': selected_style,
         'size': final_size_str,
-        'n_images': n_images
+        'n_images': n_images,
+        'use_cache': use_cache,
+        'hedge': hedge
     }
 
 def show_advanced_options(provider: str) -> Dict:
@@ -1212,6 +4212,8 @@ def main():
     """主應用函數"""
     # 初始化
     init_session_state()
+    pin_favorite_images()
+    sync_profile_health()
     client = init_api_client()
     cfg = get_active_config()
     api_configured = cfg and cfg.get('validated', False)
@@ -1225,8 +4227,9 @@ def main():
     st.caption(f"支援 FLUX、Stable Diffusion、DALL-E 及更多模型 | {VERSION}")
     
     # 主界面標籤頁
-    tab1, tab2, tab3, tab4 = st.tabs([
+    tab1, tab_sweep, tab2, tab3, tab4 = st.tabs([
         "🚀 生成圖像",
+        "🧪 參數掃描",
         f"📚 歷史 ({len(st.session_state.generation_history)})",
         f"⭐ 收藏 ({len(st.session_state.favorite_images)})",
         "ℹ️ 關於"
@@ -1235,6 +4238,9 @@ def main():
     with tab1:
         show_generation_tab(api_configured, client)
     
+    with tab_sweep:
+        show_sweep_tab(api_configured, client)
+    
     with tab2:
         show_history_tab()
     
@@ -1257,6 +4263,7 @@ def show_sidebar(api_configured: bool, client, cfg: Dict):
     if api_configured:
         provider_info = API_PROVIDERS.get(cfg['provider'], {})
         st.success(f"🟢 已連接: {st.session_state.active_profile_name}")
+        show_circuit_status(cfg)
         st.info(f"{provider_info.get('icon', '🤖')} {provider_info.get('name', cfg['provider'])}")
         
         # 模型發現
@@ -1264,17 +4271,30 @@ def show_sidebar(api_configured: bool, client, cfg: Dict):
         
         if st.button("🔍 發現模型", use_container_width=True, disabled=not can_discover):
             with st.spinner("🔍 正在發現可用模型..."):
-                discovered = auto_discover_models(client, cfg['provider'], cfg['base_url'])
-                st.session_state.discovered_models = discovered
-                
-                if discovered:
-                    st.success(f"✅ 發現 {len(discovered)} 個新模型！")
+                try:
+                    status = get_model_discovery().refresh(cfg)
+                except Exception as e:
+                    st.error(f"模型發現失敗: {str(e)[:100]}")
                 else:
-                    st.warning("⚠️ 未發現新模型")
-                
-                time.sleep(1)
-                rerun_app()
+                    if status["not_modified"]:
+                        st.info(f"ℹ️ 模型列表未變化（{status['count']} 個模型）")
+                    elif status["count"]:
+                        st.success(f"✅ 發現 {status['count']} 個新模型！")
+                    else:
+                        st.warning("⚠️ 未發現新模型")
+                    
+                    time.sleep(1)
+                    rerun_app()
+        
+        discovery_status = get_model_discovery().status(cfg) if can_discover else None
+        if discovery_status and discovery_status["fetched_at"]:
+            age_minutes = int((time.time() - discovery_status["fetched_at"]) // 60)
+            st.caption(f"🔍 已發現 {discovery_status['count']} 個模型 · {age_minutes} 分鐘前更新")
+        if discovery_status and discovery_status["error"]:
+            st.caption(f"⚠️ 後台模型發現失敗，使用上次結果: {discovery_status['error']}")
     
+    elif cfg and get_profile_health().status(cfg)["checking"]:
+        st.info(f"⏳ 正在驗證: '{st.session_state.active_profile_name}'")
     elif st.session_state.api_profiles:
         st.error(f"🔴 配置錯誤: '{st.session_state.active_profile_name}' 未驗證")
     else:
@@ -1283,11 +4303,45 @@ def show_sidebar(api_configured: bool, client, cfg: Dict):
     st.markdown("---")
     
     # 統計信息
+    cache_stats = get_generation_cache().summary()
+    retry_stats = get_retry_metrics().snapshot(cfg.get('provider', '')) if cfg else {}
+    tracker = get_latency_tracker(cfg.get('provider', '') if cfg else '', st.session_state.get('selected_model'))
+    p50, p95 = tracker.percentile("total", 0.5), tracker.percentile("total", 0.95)
+    latency_text = f"{p50:.1f}/{p95:.1f} 秒" if p50 is not None else "樣本不足"
+    read_timeout = tracker.timeouts(float(cfg.get('timeout_ceiling') or REQUEST_TIMEOUT) if cfg else REQUEST_TIMEOUT)["read"]
+    scheduler_stats = get_fair_scheduler().snapshot()
+    if cfg:
+        window_stats = get_concurrency_limiter(cfg).snapshot()
+        window_text = (f"{window_stats['window']:.1f}/{window_stats['ceiling']}（進行中 {window_stats['in_flight']}，"
+                       f"增 {window_stats['increases']} / 減 {window_stats['decreases']}）")
+    else:
+        window_text = "未配置"
+    hedge_stats = get_hedge_budget(cfg).snapshot() if cfg else {"hedges": 0, "wins": 0, "denied": 0}
+    warmup_stats = get_model_warmup().snapshot()
+    health_stats = get_profile_health().snapshot()
+    limiter = get_rate_limiter(cfg) if cfg else None
+    if limiter is not None:
+        limiter_stats = limiter.snapshot()
+        limiter_text = (f"{limiter_stats['rate'] * 60:.0f} 次/分，等待 {limiter_stats['waited']} 次 / "
+                        f"累計 {limiter_stats['wait_seconds']:.0f} 秒 / 最長 {limiter_stats['max_wait']:.1f} 秒")
+    else:
+        limiter_text = "未限制"
+    wait_text = f"{scheduler_stats['wait_p95']:.1f} 秒" if scheduler_stats['wait_p95'] is not None else "無"
     st.info(f"""
     **📊 使用統計**
     - 歷史記錄: {len(st.session_state.generation_history)}/{MAX_HISTORY_ITEMS}
     - 收藏圖片: {len(st.session_state.favorite_images)}/{MAX_FAVORITE_ITEMS}
     - 批次上限: {MAX_BATCH_SIZE}
+    - 快取命中: {cache_stats['hits']} / 未命中: {cache_stats['misses']}
+    - 快取容量: {cache_stats['entries']} 條 ({cache_stats['bytes'] / 1024 / 1024:.1f}/{CACHE_MAX_BYTES // 1024 // 1024} MB)
+    - 請求嘗試: {retry_stats.get('attempts', 0)} / 重試: {retry_stats.get('retries', 0)} / 放棄: {retry_stats.get('giveups', 0)}
+    - 模型延遲 p50/p95: {latency_text}（超時 {read_timeout:.0f} 秒）
+    - 限流: {limiter_text}
+    - 併發窗口: {window_text}
+    - 對沖請求: 發出 {hedge_stats['hedges']} / 勝出 {hedge_stats['wins']} / 超出預算 {hedge_stats['denied']}
+    - 模型冷啟動: {warmup_stats['cold_starts']} 次 / 預熱請求: {warmup_stats['warmups']} 次
+    - 存檔檢查: {health_stats['checks']} 次 / 失敗 {health_stats['failures']} 次
+    - 排程: 執行 {scheduler_stats['running']}/{scheduler_stats['capacity']} / 排隊 {scheduler_stats['queued']} / 會話 {scheduler_stats['sessions']}（等待 p95 {wait_text}）
     """)
     
     # 快捷操作
@@ -1302,6 +4356,33 @@ def show_sidebar(api_configured: bool, client, cfg: Dict):
         st.success("收藏已清空")
         time.sleep(1)
         rerun_app()
+    
+    if st.button("🗑️ 清空快取", use_container_width=True):
+        get_generation_cache().clear()
+        st.success("結果快取已清空")
+        time.sleep(1)
+        rerun_app()
+
+def show_circuit_status(cfg: Dict):
+    """顯示當前存檔各模型的熔斷器狀態"""
+    prefix = endpoint_key(cfg)
+    registry = get_circuit_registry()
+    with registry["lock"]:
+        breakers = {model: breaker for (key, model), breaker in registry["breakers"].items()
+                    if key == prefix}
+    
+    selected_model = st.session_state.get('selected_model')
+    if selected_model not in breakers:
+        st.caption(f"🔌 熔斷器: 🟢 閉合 ({selected_model or '未選擇模型'})")
+    
+    for model, breaker in breakers.items():
+        state = breaker.current_state()
+        if state == CircuitBreaker.OPEN:
+            st.caption(f"🔌 熔斷器: 🔴 斷開 ({model}，{breaker.seconds_until_probe():.0f} 秒後探測)")
+        elif state == CircuitBreaker.HALF_OPEN:
+            st.caption(f"🔌 熔斷器: 🟡 半開 ({model}，等待探測)")
+        elif model == selected_model:
+            st.caption(f"🔌 熔斷器: 🟢 閉合 ({model})")
 
 def show_generation_tab(api_configured: bool, client):
     """顯示生成標籤頁"""
@@ -1329,13 +4410,33 @@ def show_generation_tab(api_configured: bool, client):
     cfg = get_active_config()
     advanced_options = show_advanced_options(cfg.get('provider', ''))
     
-    # 生成按鈕和邏輯
+    # 多存檔模式：在其他已驗證存檔的等效模型之間路由或競速
+    race_targets = find_race_targets(selected_model)
+    route_entries = [(st.session_state.active_profile_name, cfg, selected_model, client)] + race_targets
+    multi_mode = "單一存檔"
+    if race_targets:
+        multi_mode = st.radio(
+            f"🔀 多存檔模式（另有 {len(race_targets)} 個等效存檔）",
+            ["單一存檔", "🧭 智能路由", "🏁 競速"],
+            horizontal=True,
+            help="智能路由：按成功率、延遲、剩餘配額和成本選擇存檔，失敗時自動轉移；"
+                 "競速：同時請求所有等效存檔，採用最先完成的結果（會消耗額外的請求配額）"
+        )
+        if multi_mode == "🧭 智能路由":
+            ranked = rank_routes(route_entries)
+            st.caption("🧭 路由評分: " + " / ".join(
+                f"{name} {score:.2f}" if score is not None else f"{name} 熔斷中"
+                for (name, _, _, _), score in ranked
+            ))
+    
+    # 生成按鈕和邏輯：提交後台任務後立即返回，可以繼續編輯參數
+    active_jobs = st.session_state.active_jobs
     generation_disabled = (
         not gen_params['prompt'].strip() or
-        st.session_state.get('generation_in_progress', False)
+        len(active_jobs) >= MAX_ACTIVE_JOBS_PER_SESSION
     )
     
-    button_text = "🎨 正在生成..." if st.session_state.get('generation_in_progress') else "🚀 生成圖像"
+    button_text = f"🚀 生成圖像（{len(active_jobs)} 個任務進行中）" if active_jobs else "🚀 生成圖像"
     
     if st.button(
         button_text,
@@ -1344,9 +4445,7 @@ def show_generation_tab(api_configured: bool, client):
         disabled=generation_disabled
     ):
         # 構建最終提示詞
-        final_prompt = gen_params['prompt']
-        if gen_params['style'] != "無" and STYLE_PRESETS[gen_params['style']]:
-            final_prompt = f"{final_prompt}, {STYLE_PRESETS[gen_params['style']]}"
+        final_prompt = build_final_prompt(gen_params['prompt'], gen_params['style'])
         
         # 生成參數
         params = {
@@ -1358,55 +4457,387 @@ def show_generation_tab(api_configured: bool, client):
             **advanced_options
         }
         
-        # 顯示生成信息
         model_name = all_models[selected_model]['name']
-        with st.spinner(f"🎨 正在使用 {model_name} 生成 {gen_params['n_images']} 張圖像..."):
-            success, result = generate_images_with_retry(client, **params)
-        
-        # 處理結果
-        if success and hasattr(result, 'data') and result.data:
-            img_b64s = [img.b64_json for img in result.data]
-            
-            # 添加到歷史
-            add_to_history(
-                gen_params['prompt'],
-                gen_params['negative_prompt'],
-                selected_model,
-                img_b64s,
-                {
+        job = GenerationJob(
+            get_session_id(), client, cfg, params, gen_params['use_cache'],
+            {
+                "prompt": gen_params['prompt'],
+                "negative_prompt": gen_params['negative_prompt'],
+                "model": selected_model,
+                "history": {
                     "size": gen_params['size'],
                     "provider": cfg['provider'],
                     "style": gen_params['style'],
                     "n": gen_params['n_images'],
                     "model_name": model_name,
-                    "advanced_options": advanced_options
+                    "advanced_options": advanced_options,
+                    "request_params": params
                 }
-            )
-            
-            st.success(f"✨ 成功生成 {len(img_b64s)} 張圖像！")
-            
-            # 顯示生成的圖像
-            if len(img_b64s) == 1:
-                display_image_with_actions(
-                    img_b64s[0],
-                    f"{st.session_state.generation_history[0]['id']}_0",
-                    st.session_state.generation_history[0]
+            },
+            hedge=gen_params['hedge'],
+            race=race_targets if multi_mode == "🏁 競速" else None,
+            route=route_entries if multi_mode == "🧭 智能路由" else None
+        )
+        get_job_manager().submit(job)
+        st.session_state.active_jobs = active_jobs + [job.id]
+        rerun_app()
+    
+    show_job_monitor()
+    show_last_job_result()
+
+def find_race_targets(model: str) -> List[Tuple]:
+    """查找其他已驗證存檔中與當前模型等效的模型，返回 (存檔名, 配置, 模型, 客戶端) 列表"""
+    active_name = st.session_state.active_profile_name
+    cfg = get_active_config()
+    family = next((members for members in MODEL_EQUIVALENCE.values()
+                   if members.get(cfg.get('provider')) == model), None)
+    if not family:
+        return []
+    
+    targets = []
+    seen = {endpoint_key(cfg)}
+    for name, profile in st.session_state.api_profiles.items():
+        provider = profile.get('provider')
+        if name == active_name or not profile.get('validated') or provider not in family:
+            continue
+        if endpoint_key(profile) in seen:
+            continue
+        
+        client = None
+        if provider not in ["Pollinations.ai", "Hugging Face"]:
+            if not profile.get('api_key'):
+                continue
+            client = get_openai_client(profile['api_key'], profile['base_url'])
+        
+        seen.add(endpoint_key(profile))
+        targets.append((name, profile, family[provider], client))
+        if len(targets) >= RACE_MAX_CANDIDATES - 1:
+            break
+    return targets
+
+def collect_finished_job(snapshot: Dict):
+    """在主執行緒中領取已結束的任務：寫入歷史並記錄結果提示"""
+    meta = snapshot['metadata']
+    if snapshot['state'] == "done":
+        if snapshot['race_winner']:
+            meta['history']['race_winner'] = snapshot['race_winner']
+        if snapshot['served_by']:
+            meta['history']['served_by'] = snapshot['served_by']
+        meta['history']['images_meta'] = snapshot['images_meta']
+        add_to_history(
+            meta['prompt'],
+            meta['negative_prompt'],
+            meta['model'],
+            snapshot['result'],
+            meta['history']
+        )
+        st.session_state.last_job_result = {
+            "history_id": st.session_state.generation_history[0]['id'],
+            "slots": snapshot['slots'],
+            "cancelled": snapshot['cancelled'],
+            "count": len(snapshot['result']),
+            "cached": snapshot['cached'],
+            "race_winner": snapshot['race_winner'],
+            "served_by": snapshot['served_by'],
+            "warnings": snapshot['warnings'],
+        }
+    else:
+        st.session_state.last_job_result = {
+            "error": snapshot['error'],
+            "warnings": snapshot['warnings'],
+            "cancelled": snapshot['cancelled'],
+        }
+    st.session_state.last_generation_time = datetime.datetime.now()
+
+def render_job_status():
+    """顯示進行中的任務及已完成的圖片，並領取已結束的任務"""
+    manager = get_job_manager()
+    remaining = []
+    collected = False
+    
+    for job_id in st.session_state.active_jobs:
+        job = manager.get(job_id)
+        if job is None:
+            continue
+        
+        snapshot = job.snapshot()
+        if snapshot['state'] in ("done", "failed"):
+            collect_finished_job(snapshot)
+            manager.forget(job_id)
+            collected = True
+            continue
+        
+        remaining.append(job_id)
+        meta = snapshot['metadata']
+        label = f"{meta['history'].get('model_name', meta['model'])}: {meta['prompt'][:40]}"
+        col_progress, col_cancel = st.columns([5, 1])
+        with col_progress:
+            if snapshot['cancelled']:
+                st.progress(min(snapshot['fraction'], 1.0), text=f"⏹️ 正在取消 — {label}")
+            elif snapshot['state'] == "queued":
+                st.progress(0.0, text=f"⏳ 排隊中 — {label}")
+            else:
+                st.progress(
+                    min(snapshot['fraction'], 1.0),
+                    text=(f"🎨 {label} — {snapshot['completed']}/{snapshot['total']} 張完成"
+                          f"（{snapshot['downloaded_bytes'] / 1024:.0f} KB，{snapshot['elapsed']:.0f} 秒）")
                 )
+        with col_cancel:
+            if st.button("⏹️ 取消", key=f"cancel_{job_id}", disabled=snapshot['cancelled'],
+                         use_container_width=True, help="停止發出剩餘請求並中止進行中的下載，保留已完成的圖片"):
+                job.cancel()
+        
+        # 每張圖片完成後立即填入其網格位置
+        size = meta['history']['size']
+        
+        def show_image(i: int, blob_id: str):
+            data = get_blob_store().read(blob_id)
+            st.image(data if data is not None else build_placeholder_image(size), use_container_width=True)
+        
+        render_image_slots(snapshot['slots'], size, show_image)
+    
+    st.session_state.active_jobs = remaining
+    if collected:
+        rerun_app()
+
+@st.cache_data(show_spinner=False)
+def build_placeholder_image(size: str) -> bytes:
+    """生成與目標尺寸比例相同的佔位圖，使網格在圖片到達前後保持同樣的高度"""
+    try:
+        width, height = (int(v) for v in str(size).split('x'))
+    except ValueError:
+        width, height = 1, 1
+    img = Image.new("RGB", (PLACEHOLDER_WIDTH, max(1, round(PLACEHOLDER_WIDTH * height / width))), (236, 238, 242))
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def render_image_slots(slots: List[Dict], size: str, render_image):
+    """按序號把每張圖片放在固定的網格位置：已完成的調用 render_image，失敗的就地顯示錯誤，其餘顯示佔位圖"""
+    cols = st.columns(1 if len(slots) == 1 else RESULT_GRID_COLUMNS)
+    for i, slot in enumerate(slots):
+        with cols[i % len(cols)]:
+            if slot['state'] == "done":
+                render_image(i, slot['blob_id'])
+            elif slot['state'] == "failed":
+                st.image(build_placeholder_image(size), use_container_width=True)
+                st.error(f"❌ {slot['error']}")
             else:
-                cols = st.columns(2)
-                for i, b64_json in enumerate(img_b64s):
-                    with cols[i % 2]:
-                        display_image_with_actions(
-                            b64_json,
-                            f"{st.session_state.generation_history[0]['id']}_{i}",
-                            st.session_state.generation_history[0]
-                        )
-            
-            # 清理內存
-            gc.collect()
+                st.image(build_placeholder_image(size), caption=f"⏳ 第 {i + 1} 張生成中…",
+                         use_container_width=True)
+
+def run_polling(render_fn):
+    """定期重新渲染 render_fn：優先使用局部刷新，避免整頁重跑"""
+    fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+    if fragment is not None:
+        fragment(run_every=JOB_POLL_INTERVAL)(render_fn)()
+    else:
+        render_fn()
+        time.sleep(JOB_POLL_INTERVAL)
+        rerun_app()
+
+def show_job_monitor():
+    """輪詢後台任務狀態"""
+    if st.session_state.active_jobs:
+        run_polling(render_job_status)
+
+def show_last_job_result():
+    """顯示最近一次完成的任務結果"""
+    result = st.session_state.last_job_result
+    if not result:
+        return
+    
+    if 'error' in result and result.get('cancelled'):
+        st.info("⏹️ 任務已取消")
+        return
+    
+    if 'error' in result:
+        for warning in result.get('warnings', []):
+            st.warning(f"⚠️ {warning}")
+        st.error(f"❌ 生成失敗: {result['error']}")
+        return
+    
+    history_item = next((item for item in st.session_state.generation_history
+                         if item['id'] == result['history_id']), None)
+    if history_item is None:
+        return
+    
+    if result.get('cancelled'):
+        st.info(f"⏹️ 任務已取消，保留已完成的 {result['count']} 張圖像")
+    elif result['cached']:
+        st.success(f"♻️ 已從快取載入 {result['count']} 張圖像！")
+    elif result.get('race_winner'):
+        st.success(f"🏁 {result['race_winner']} 競速勝出，成功生成 {result['count']} 張圖像！")
+    elif result.get('served_by'):
+        st.success(f"🧭 由 {' → '.join(result['served_by'])} 成功生成 {result['count']} 張圖像！")
+    else:
+        st.success(f"✨ 成功生成 {result['count']} 張圖像！")
+    
+    # 失敗的圖片在其位置上顯示錯誤，網格與生成過程中保持一致
+    render_image_slots(
+        result['slots'], history_item['metadata'].get('size', ''),
+        lambda i, blob_id: display_image_with_actions(blob_id, f"{history_item['id']}_{i}", history_item)
+    )
+    
+    # 清理內存
+    gc.collect()
+
+def show_sweep_tab(api_configured: bool, client):
+    """顯示參數掃描標籤頁：提示詞 × 風格 × 尺寸 × 模型 × 種子"""
+    if not api_configured:
+        st.warning("⚠️ 請在側邊欄配置並驗證API供應商")
+        return
+    
+    all_models = merge_models()
+    if not all_models:
+        st.warning("⚠️ 沒有可用模型。請在側邊欄點擊「發現模型」")
+        return
+    
+    cfg = get_active_config()
+    col1, col2 = st.columns([2, 1])
+    with col1:
+        prompts_text = st.text_area(
+            "✍️ 提示詞（每行一個）",
+            key="sweep_prompts",
+            height=120,
+            placeholder="a lighthouse at dusk\na cabin in the snow"
+        )
+        negative_prompt = st.text_input("🚫 負向提示詞（所有組合共用）", key="sweep_negative_prompt")
+        seeds_text = st.text_input(
+            "🎲 種子",
+            key="sweep_seeds",
+            placeholder="例如 1, 2, 3 或 100-107，留空為隨機",
+        )
+    with col2:
+        styles = st.multiselect("🎨 風格", list(STYLE_PRESETS.keys()), default=["無"], key="sweep_styles")
+        sizes = st.multiselect(
+            "📐 尺寸",
+            [size for size in IMAGE_SIZES if size != "自定義..."],
+            default=["1024x1024"],
+            format_func=lambda x: f"{x} {IMAGE_SIZES[x]}",
+            key="sweep_sizes"
+        )
+        default_model = st.session_state.get('selected_model')
+        models = st.multiselect(
+            "🤖 模型",
+            list(all_models.keys()),
+            default=[default_model] if default_model in all_models else [],
+            format_func=lambda x: all_models[x].get('name', x),
+            key="sweep_models"
+        )
+        spread = st.toggle(
+            "🧭 分散到等效存檔",
+            value=False,
+            help="每個組合按智能路由評分發往當前或其他已驗證存檔的等效模型"
+        )
+        use_cache = st.toggle("♻️ 使用結果快取", value=True, key="sweep_use_cache")
+    
+    prompts = list(dict.fromkeys(line.strip() for line in prompts_text.splitlines() if line.strip()))
+    try:
+        seeds = parse_seed_list(seeds_text)
+    except ValueError as e:
+        st.error(f"❌ 種子無效: {e}")
+        seeds = []
+    
+    cells, total = expand_sweep(prompts, styles, sizes, models, seeds, negative_prompt, limit=SWEEP_MAX_CELLS)
+    st.caption(f"📊 共 {total} 個組合（已合併重複請求，上限 {SWEEP_MAX_CELLS}）")
+    if total > SWEEP_MAX_CELLS:
+        st.warning(f"⚠️ 組合數超過上限 {SWEEP_MAX_CELLS}，請減少維度")
+    
+    sweep_running = st.session_state.active_sweep is not None
+    if st.button(
+        "🧪 掃描中..." if sweep_running else "🧪 開始掃描",
+        type="primary",
+        use_container_width=True,
+        disabled=sweep_running or not cells
+    ):
+        if spread:
+            routes = {model: [(st.session_state.active_profile_name, cfg, model, client)] + find_race_targets(model)
+                      for model in models}
+            for cell in cells:
+                route = routes[cell["params"]["model"]]
+                cell["route"] = route if len(route) > 1 else None
         
+        job = SweepJob(get_session_id(), client, cfg, cells, use_cache)
+        get_job_manager().submit(job)
+        st.session_state.active_sweep = job.id
+        rerun_app()
+    
+    if st.session_state.active_sweep:
+        run_polling(render_sweep_status)
+    elif st.session_state.last_sweep:
+        render_sweep_grid(st.session_state.last_sweep, interactive=True)
+
+def render_sweep_status():
+    """顯示進行中的掃描，結束後保存結果"""
+    manager = get_job_manager()
+    job = manager.get(st.session_state.active_sweep)
+    if job is None:
+        st.session_state.active_sweep = None
+        rerun_app()
+        return
+    
+    snapshot = job.snapshot()
+    if snapshot['state'] == "done":
+        st.session_state.last_sweep = snapshot
+        st.session_state.active_sweep = None
+        manager.forget(snapshot['id'])
+        rerun_app()
+        return
+    
+    finished = sum(1 for cell in snapshot['cells'] if cell['state'] in ("done", "failed"))
+    total = len(snapshot['cells'])
+    col_progress, col_cancel = st.columns([5, 1])
+    with col_progress:
+        status = "⏹️ 正在取消" if snapshot['cancelled'] else "🧪 掃描中"
+        st.progress(finished / total, text=f"{status} — {finished}/{total}（{snapshot['elapsed']:.0f} 秒）")
+    with col_cancel:
+        if st.button("⏹️ 取消", key=f"cancel_{snapshot['id']}", disabled=snapshot['cancelled'],
+                     use_container_width=True, help="停止剩餘的組合，保留已完成的結果"):
+            job.cancel()
+    render_sweep_grid(snapshot, interactive=False)
+
+def render_sweep_grid(snapshot: Dict, interactive: bool):
+    """以網格顯示掃描結果，標籤只列出有變化的維度"""
+    cells = snapshot['cells']
+    dimension_names = {"prompt": "📝", "style": "🎨", "size": "📐", "model": "🤖", "seed": "🎲"}
+    varying = [dim for dim in dimension_names
+               if len({str(cell['label'][dim]) for cell in cells}) > 1]
+    
+    if interactive:
+        done = sum(1 for cell in cells if cell['state'] == "done")
+        if snapshot.get('cancelled'):
+            st.info(f"⏹️ 掃描已取消：{done}/{len(cells)} 個組合完成（{snapshot['elapsed']:.0f} 秒）")
         else:
-            st.error(f"❌ 生成失敗: {result}")
+            st.success(f"✨ 掃描完成：{done}/{len(cells)} 個組合成功（{snapshot['elapsed']:.0f} 秒）")
+    
+    cols = st.columns(SWEEP_GRID_COLUMNS)
+    for i, cell in enumerate(cells):
+        label = " / ".join(f"{dimension_names[dim]} {cell['label'][dim]}" for dim in varying) or f"#{i + 1}"
+        with cols[i % SWEEP_GRID_COLUMNS]:
+            st.caption(label)
+            if cell['state'] == "done" and interactive:
+                display_image_with_actions(
+                    cell['blob_id'], f"sweep_{snapshot['id']}_{i}",
+                    {
+                        "prompt": cell['label']['prompt'],
+                        "negative_prompt": cell['params']['negative_prompt'],
+                        "model": cell['params']['model'],
+                        "images": [cell['blob_id']],
+                        "metadata": {"size": cell['params']['size'], "style": cell['label']['style'],
+                                     "seed": cell['label']['seed'], "provider": snapshot['provider'],
+                                     "request_params": cell['params'],
+                                     "images_meta": [{"seed": cell.get('seed'), "params": cell.get('resolved', {})}]}
+                    }
+                )
+            elif cell['state'] == "done":
+                data = get_blob_store().read(cell['blob_id'])
+                if data is not None:
+                    st.image(data, use_container_width=True)
+            elif cell['state'] == "failed":
+                st.error(f"❌ {str(cell['error'])[:80]}")
+            else:
+                st.info("⏳ 排隊中" if cell['state'] == "queued" else "🎨 生成中")
 
 def show_history_tab():
     """顯示歷史標籤頁"""
@@ -1460,10 +4891,10 @@ def show_history_tab():
                 )
             else:
                 cols = st.columns(2)
-                for i, b64_json in enumerate(item['images']):
+                for i, blob_id in enumerate(item['images']):
                     with cols[i % 2]:
                         display_image_with_actions(
-                            b64_json,
+                            blob_id,
                             f"hist_{item['id']}_{i}",
                             item
                         )
@@ -1494,7 +4925,7 @@ def show_favorites_tab():
     for i, fav in enumerate(sorted_favorites):
         with cols[i % 3]:
             display_image_with_actions(
-                fav['image_b64'],
+                fav['blob_id'],
                 fav['id'],
                 fav.get('history_item', {})
             )
@@ -1585,5 +5016,200 @@ def show_footer():
     </div>
     """, unsafe_allow_html=True)
 
+# === 命令行批次執行 ===
+
+class CliReporter(BatchReporter):
+    """命令行任務的事件接收者：記錄每張圖片所在的序號和失敗原因"""
+    
+    owner = "cli"
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.slots: Dict[str, List[int]] = {}  # blob_id -> 序號（相同內容的圖片可能有多個）
+        self.failures: List[str] = []
+    
+    def report_image(self, index: int, blob_id: str):
+        with self._lock:
+            self.slots.setdefault(blob_id, []).append(index)
+    
+    def report_failure(self, index: int, message: str):
+        with self._lock:
+            self.failures.append(message)
+    
+    def slot_of(self, blob_id: str, fallback: int) -> int:
+        """返回圖片在批次中的原始序號"""
+        with self._lock:
+            slots = self.slots.get(blob_id)
+            return slots.pop(0) if slots else fallback
+
+def read_prompt_rows(path: str) -> List[Dict]:
+    """讀取 JSONL 或 CSV 提示詞文件"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith(".csv"):
+            return [dict(row) for row in csv.DictReader(f)]
+        return [json.loads(line) for line in f if line.strip()]
+
+def row_key(index: int, row: Dict) -> str:
+    """行的續跑標識：行號 + 內容雜湊，修改過的行會重新生成"""
+    canonical = json.dumps(row, sort_keys=True, ensure_ascii=False)
+    return f"{index}:{hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:12]}"
+
+def build_row_params(row: Dict, default_model: str) -> Dict:
+    """把提示詞文件中的一行轉換為生成參數"""
+    prompt = str(row.get("prompt") or "").strip()
+    if not prompt:
+        raise ValueError("缺少 prompt")
+    
+    style = row.get("style") or "無"
+    if style not in STYLE_PRESETS:
+        raise ValueError(f"未知的風格預設: {style}")
+    
+    size = str(row.get("size") or "1024x1024")
+    if not re.fullmatch(r"\d+x\d+", size):
+        raise ValueError(f"無效的尺寸: {size}")
+    
+    n_images = int(row.get("n") or 1)
+    if not 1 <= n_images <= MAX_BATCH_SIZE:
+        raise ValueError(f"n 必須在 1 到 {MAX_BATCH_SIZE} 之間")
+    
+    params = {
+        "model": row.get("model") or default_model,
+        "prompt": build_final_prompt(prompt, style),
+        "negative_prompt": row.get("negative_prompt") or "",
+        "size": size,
+        "n": n_images,
+    }
+    if row.get("seed") not in (None, ""):
+        params["seed"] = int(row["seed"])
+    return params
+
+def load_manifest(path: str) -> Dict[str, Dict]:
+    """讀取已有的清單，返回已完成行的記錄"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # 中斷時可能留下半行
+                continue
+            if entry.get("status") == "done":
+                done[entry["key"]] = entry
+    return done
+
+def export_blob(blob_id: str, directory: str, stem: str) -> str:
+    """把圖片文件寫出到輸出目錄，返回相對路徑"""
+    data = get_blob_store().read(blob_id)
+    if data is None:
+        raise GenerationError("圖片文件已被淘汰")
+    try:
+        extension = (Image.open(BytesIO(data)).format or "png").lower()
+    except Exception:
+        extension = "png"
+    
+    relative = os.path.join("images", f"{stem}.{extension}")
+    target = os.path.join(directory, relative)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, target)
+    return relative
+
+def run_cli(argv: Optional[List[str]] = None) -> int:
+    """命令行入口：批次讀取提示詞文件並生成圖片，支持中斷後續跑"""
+    parser = argparse.ArgumentParser(description=f"{APP_TITLE} 命令行批次生成")
+    parser.add_argument("input", nargs="?", help="提示詞文件（.jsonl 或 .csv），每行含 prompt、negative_prompt、style、size、model、seed、n")
+    parser.add_argument("-o", "--output", help="輸出目錄（圖片及 manifest.jsonl）")
+    parser.add_argument("-p", "--profile", help="使用的 API 存檔名（默認為第一個存檔）")
+    parser.add_argument("-m", "--model", help="行內未指定模型時使用的模型")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="同時處理的行數")
+    parser.add_argument("--no-cache", action="store_true", help="不使用結果快取")
+    parser.add_argument("--list-profiles", action="store_true", help="列出可用的存檔後退出")
+    args = parser.parse_args(argv)
+    
+    # 命令行模式下沒有 Streamlit 運行時，過濾工作執行緒的上下文缺失警告
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("streamlit"):
+            logging.getLogger(name).addFilter(lambda record: "ScriptRunContext" not in record.getMessage())
+    
+    profiles = load_base_profiles()
+    if args.list_profiles:
+        for name, cfg in profiles.items():
+            print(f"{name}\t{cfg.get('provider')}\t{cfg.get('base_url')}")
+        return 0
+    if not args.input or not args.output:
+        parser.error("需要指定提示詞文件和輸出目錄（-o）")
+    
+    profile_name = args.profile or next(iter(profiles))
+    if profile_name not in profiles:
+        parser.error(f"找不到存檔: {profile_name}")
+    cfg = profiles[profile_name]
+    provider = cfg.get('provider')
+    
+    client = None
+    if provider not in ["Pollinations.ai", "Hugging Face"]:
+        client = get_openai_client(cfg['api_key'], cfg['base_url'])
+    default_model = args.model or next(iter(API_PROVIDERS.get(provider, {}).get('hardcoded_models', BASE_MODELS)))
+    
+    os.makedirs(os.path.join(args.output, "images"), exist_ok=True)
+    manifest_path = os.path.join(args.output, "manifest.jsonl")
+    done = load_manifest(manifest_path)
+    rows = read_prompt_rows(args.input)
+    pending = [(i, row) for i, row in enumerate(rows) if row_key(i, row) not in done]
+    print(f"共 {len(rows)} 行，已完成 {len(rows) - len(pending)} 行，待處理 {len(pending)} 行（存檔: {profile_name}）")
+    
+    manifest_lock = threading.Lock()
+    failures = 0
+    
+    def process(index: int, row: Dict) -> bool:
+        key = row_key(index, row)
+        started = time.monotonic()
+        entry = {"key": key, "line": index + 1, "row": row, "profile": profile_name}
+        try:
+            params = build_row_params(row, default_model)
+            reporter = CliReporter()
+            success, result = generate_images_with_retry(
+                client, cfg, reporter, use_cache=not args.no_cache, **params
+            )
+            if not success:
+                raise GenerationError(str(result))
+            # 文件按圖片在批次中的原始序號命名，與 seeds 一一對應
+            files = [export_blob(img.blob_id, args.output, f"{index + 1:05d}_{reporter.slot_of(img.blob_id, i)}")
+                     for i, img in enumerate(result.data)]
+            entry.update(files=files, params=params, seeds=[getattr(img, 'seed', None) for img in result.data])
+            if len(files) < params.get("n", 1):
+                # 部分圖片失敗的行不算完成，續跑時重新生成
+                entry.update(status="partial", error="；".join(reporter.failures)[:300] or "部分圖片沒有返回")
+            else:
+                entry["status"] = "done"
+        except Exception as e:
+            entry.update(status="failed", error=str(e)[:300])
+        entry["elapsed"] = round(time.monotonic() - started, 2)
+        
+        with manifest_lock:
+            with open(manifest_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            mark = {"done": "✅", "partial": "⚠️"}.get(entry["status"], "❌")
+            detail = {
+                "done": f"{len(entry.get('files', []))} 張",
+                "partial": f"{len(entry.get('files', []))}/{entry.get('params', {}).get('n', 1)} 張，{entry.get('error')}",
+            }.get(entry["status"], entry.get("error"))
+            print(f"[{index + 1}/{len(rows)}] {mark} {str(row.get('prompt', ''))[:40]} — {detail}（{entry['elapsed']} 秒）",
+                  flush=True)
+        return entry["status"] == "done"
+    
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency), thread_name_prefix="cli") as executor:
+        for ok in executor.map(lambda item: process(*item), pending):
+            failures += 0 if ok else 1
+    
+    print(f"完成：成功 {len(pending) - failures} 行，失敗 {failures} 行，清單: {manifest_path}")
+    return 1 if failures else 0
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 經由 streamlit run 啟動時顯示界面，直接以 python 執行時進入命令行模式
+    if st.runtime.exists():
+        main()
+    else:
+        sys.exit(run_cli())
\ No newline at end of file